@@ -0,0 +1,56 @@
+"""
+Header layout benchmark: very wide and very deep section trees.
+Row sections are used, because a worksheet has only 256 columns.
+
+Usage: python headers.py [row fields] [depth]
+
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from xlwt import Workbook
+from xlrep import Report
+
+width = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+depth = int(sys.argv[2]) if len(sys.argv) > 2 else 150
+
+def wide_report():
+    """width row fields in sections of 100 fields, 3 levels deep"""
+    report = Report('Wide headers')
+    for i in range(0, width, 10000):
+        group = report.rows.add_section('group %d' % i)
+        for j in range(i, min(i + 10000, width), 100):
+            section = group.add_section('section %d' % j)
+            for k in range(j, min(j + 100, width, i + 10000)):
+                section.add_field('row %d' % k)
+    report.cols.add_field('col')
+    return report, [[1]] * width
+
+def deep_report():
+    """depth nested sections with width / depth fields and a total
+    at every level"""
+    report = Report('Deep headers')
+    section = report.rows
+    count = width // depth
+    for i in range(depth):
+        section = section.add_section('level %d' % i)
+        for j in range(count):
+            section.add_field('row %d.%d' % (i, j))
+        section.add_calc('total %d' % i, sum)
+    report.cols.add_field('col')
+    return report, [[1]] * (count * depth)
+
+def bench(make_report):
+    report, data = make_report()
+    start = time.time()
+    report.render(Workbook(style_compression=2).add_sheet('Worksheet'), data)
+    first = time.time() - start
+    start = time.time()
+    report.render(Workbook(style_compression=2).add_sheet('Worksheet'), data)
+    return first, time.time() - start
+
+print 'Wide: %d row fields      first render %.2f s, again %.2f s' % ((width,) + bench(wide_report))
+print 'Deep: %d levels, %d fields  first render %.2f s, again %.2f s' % ((depth, width // depth * depth) + bench(deep_report))
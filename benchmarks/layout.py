@@ -0,0 +1,54 @@
+"""
+Layout benchmark: building a report layout versus loading a saved one.
+
+Usage: python layout.py [rows]
+
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from xlwt import easyxf
+from xlrep import Report, layout
+
+rows = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+
+def avg(values):
+    return 1.0 * sum(values) / len(values)
+
+def build():
+    """8 column sections of 31 days, rows in sections of 100"""
+    bold = easyxf('font: bold on;')
+    report = Report('Layout benchmark')
+    for i in range(8):
+        section = report.cols.add_section('week %d' % i, header_style=bold)
+        for j in range(31):
+            section.add_field('day %d' % j, num_format='0.00')
+    report.cols.add_calc('average', avg)
+    for i in range(0, rows, 100):
+        section = report.rows.add_section('page %d' % (i // 100))
+        for j in range(min(100, rows - i)):
+            section.add_field('row %d' % (i + j))
+        section.add_calc('page total', sum, style=bold)
+    report.rows.add_calc('total', sum)
+    report.add_rule(easyxf('font: colour red;'), below=0)
+    return report
+
+def best(func, repeat=3):
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        result = func()
+        times.append(time.time() - start)
+    return min(times), result
+
+built, report = best(build)
+dumped, saved = best(lambda: layout.dumps(report))
+loaded, report = best(lambda: layout.loads(saved))
+
+print 'Rows: %d, columns: %d, layout: %d KB' % (rows, 8 * 31, len(saved) // 1024)
+print 'build:           %.3f s' % built
+print 'dump:            %.3f s' % dumped
+print 'load:            %.3f s (%.0f%% of build)' % (loaded, 100.0 * loaded / built)
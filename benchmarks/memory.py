@@ -0,0 +1,55 @@
+"""
+Memory benchmark: peak memory of Report.render in memory and with
+memory_limit (row by row rendering).
+
+Every measurement is made in a new interpreter.
+
+Usage: python memory.py [rows] [columns]
+
+"""
+import os
+import sys
+from subprocess import Popen, PIPE
+
+rows = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+cols = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+
+# Child script prints: peak memory before and after rendering (KB), render time
+child = '''
+import resource, sys, time
+from StringIO import StringIO
+from xlwt import Workbook
+from xlrep import Report
+rows, cols, limit = int(sys.argv[1]), int(sys.argv[2]), eval(sys.argv[3])
+report = Report('Memory benchmark', memory_limit=limit)
+for i in range(0, rows, 100):
+    section = report.rows.add_section('page %d' % (i // 100))
+    for j in range(min(100, rows - i)):
+        section.add_field('row %d' % (i + j))
+    section.add_calc('page total', sum)
+report.rows.add_calc('total', sum)
+cs = report.cols.add_section('cols')
+for j in range(cols):
+    cs.add_field('col %d' % j)
+report.cols.add_calc('total', sum)
+data = [[i * j % 1000 for j in range(cols)] for i in range(rows)]
+before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+start = time.time()
+book = Workbook()
+report.render(book.add_sheet('Worksheet'), data)
+book.save(StringIO())
+print before, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, time.time() - start
+'''
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+env = dict(os.environ, PYTHONPATH=root)
+
+def run(limit):
+    out, err = Popen([sys.executable, '-c', child, str(rows), str(cols), repr(limit)],
+                     stdout=PIPE, env=env).communicate()
+    before, after, elapsed = map(float, out.split())
+    return (after - before) / 1024, elapsed
+
+print 'Rows: %d, columns: %d' % (rows, cols)
+print 'in memory:       +%6.0f MB peak, %.2f s' % run(None)
+print 'memory_limit:    +%6.0f MB peak, %.2f s' % run(1 << 20)
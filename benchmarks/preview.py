@@ -0,0 +1,49 @@
+"""
+Preview benchmark: full Report.render versus render with preview
+(first rows are drawn, totals are computed over the whole data).
+
+Usage: python preview.py [rows] [preview rows]
+
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from random import randrange
+from StringIO import StringIO
+from xlwt import Workbook
+from xlrep import Report
+
+rows = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+preview = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+cols = 50
+
+data = [[randrange(1000) for j in range(cols)] for i in range(rows)]
+
+def make_report():
+    report = Report('Preview benchmark')
+    for i in range(0, rows, 100):
+        section = report.rows.add_section('page %d' % (i // 100))
+        for j in range(min(100, rows - i)):
+            section.add_field('row %d' % (i + j))
+        section.add_calc('page total', sum)
+    report.rows.add_calc('total', sum)
+    cs = report.cols.add_section('cols')
+    for j in range(cols):
+        cs.add_field('col %d' % j)
+    report.cols.add_calc('total', sum)
+    return report
+
+def bench(preview):
+    report = make_report()
+    book = Workbook()
+    start = time.time()
+    report.render(book.add_sheet('Worksheet'), data, preview=preview)
+    book.save(StringIO())
+    return time.time() - start
+
+print 'Rows: %d, columns: %d, preview: %d rows' % (rows, cols, preview)
+print 'render:          %.2f s' % bench(None)
+print 'preview:         %.2f s' % bench(preview)
@@ -0,0 +1,51 @@
+"""
+Startup benchmark: cold import time and time to the first rendered report.
+
+Every measurement is made in a new interpreter, so nothing is cached.
+
+Usage: python startup.py [runs]
+
+"""
+import os
+import sys
+from subprocess import Popen, PIPE
+
+runs = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+
+# Child script prints: import time, time to first rendered report
+child = '''
+import time
+start = time.time()
+import xlrep
+imported = time.time()
+from xlrep import Report
+from xlwt import Workbook
+from StringIO import StringIO
+report = Report('Startup benchmark')
+cs = report.cols.add_section('cols')
+for i in range(5):
+    cs.add_field('col %d' % i)
+report.cols.add_calc('total', sum)
+report.rows.add_calc('total', sum)
+book = Workbook()
+report.render(book.add_sheet('Worksheet'), [range(5) for i in range(10)])
+book.save(StringIO())
+rendered = time.time()
+print imported - start, rendered - start
+'''
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+env = dict(os.environ, PYTHONPATH=root)
+
+results = []
+for i in range(runs):
+    out, err = Popen([sys.executable, '-c', child], stdout=PIPE, env=env).communicate()
+    results.append(map(float, out.split()))
+
+def stats(values):
+    values = sorted(values)
+    return 1000 * values[0], 1000 * values[len(values) // 2]
+
+print 'Runs: %d' % runs
+print 'Cold import:          min %7.2f ms, median %7.2f ms' % stats([r[0] for r in results])
+print 'First report render:  min %7.2f ms, median %7.2f ms' % stats([r[1] for r in results])
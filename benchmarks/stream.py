@@ -0,0 +1,63 @@
+"""
+Streaming render benchmark: Report.render over fetched data versus
+Report.render_stream over the same slow data source.
+
+The data source simulates a paged API: every page of rows costs a fixed
+network latency.
+
+Usage: python stream.py [rows] [page size] [page latency, ms]
+
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from random import randrange
+from StringIO import StringIO
+from xlwt import Workbook
+from xlrep import Report
+
+rows = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+page = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+latency = float(sys.argv[3]) / 1000 if len(sys.argv) > 3 else 0.02
+cols = 50
+
+data = [[randrange(1000) for j in range(cols)] for i in range(rows)]
+
+def source():
+    for start in range(0, rows, page):
+        time.sleep(latency)
+        for row in data[start:start + page]:
+            yield row
+
+def make_report():
+    report = Report('Streaming benchmark')
+    for i in range(0, rows, page):
+        section = report.rows.add_section('page %d' % (i // page))
+        for j in range(min(page, rows - i)):
+            section.add_field('row %d' % (i + j))
+        section.add_calc('page total', sum)
+    report.rows.add_calc('total', sum)
+    cs = report.cols.add_section('cols')
+    for j in range(cols):
+        cs.add_field('col %d' % j)
+    report.cols.add_calc('total', sum)
+    return report
+
+def bench(render):
+    report = make_report()
+    book = Workbook()
+    start = time.time()
+    render(report, book.add_sheet('Worksheet'))
+    book.save(StringIO())
+    return time.time() - start
+
+fetch = rows // page * latency
+sync = bench(lambda report, ws: report.render(ws, list(source())))
+stream = bench(lambda report, ws: report.render_stream(ws, source()))
+
+print 'Rows: %d, page: %d rows, page latency: %.0f ms (%.2f s total)' % (rows, page, latency * 1000, fetch)
+print 'render:          %.2f s' % sync
+print 'render_stream:   %.2f s' % stream
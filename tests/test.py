@@ -1,8 +1,18 @@
-from xlrep import Report
-from xlwt import Workbook
+from xlrep import Report, ReportException, AggregateCache, CalcTrace, Composer, layout
+from xlrep.service import RenderService, request
+from xlrep.aggregates import Sum, Quantile, Median, DistinctCount
+from xlwt import Workbook, XFStyle, easyxf
+from datetime import date
+from decimal import Decimal
 from os import system
+from subprocess import Popen, PIPE
 from StringIO import StringIO
 
+import json
+import os
+import socket
+import sys
+import time
 import unittest
 import xlrd
 
@@ -193,6 +203,788 @@ class TestReport(unittest.TestCase):
             for j in range(4):
                 self.assertEquals(ws.cell(i+1,j+1).value, test_data[i][j])
 
+    def test_report_calc_cache(self):
+        """Test that reports with shared cache compute aggregates once"""
+
+        calls = []
+        def total(values):
+            calls.append(values)
+            return sum(values)
+
+        def make_report(caption):
+            r = Report(caption, calc_cache=cache)
+            r.cols.add_field('col 0')
+            r.cols.add_field('col 1')
+            r.cols.add_calc('col total', total)
+            rs = r.rows.add_section('rows')
+            rs.add_field('row 0')
+            rs.add_field('row 1')
+            r.rows.add_calc('row total', total)
+            return r
+
+        cache = AggregateCache()
+        data = ((1,2),(3,4))
+        book = Workbook()
+        make_report('first').render(book.add_sheet('first'), data)
+        count = len(calls)
+        make_report('second').render(book.add_sheet('second'), [list(row) for row in data])
+        self.assertEquals(len(calls), count)
+
+        compiled_report = StringIO()
+        book.save(compiled_report)
+        book = xlrd.open_workbook(file_contents=compiled_report.getvalue())
+        ws = book.sheet_by_index(1)
+        self.assertEquals([ws.cell(4,j).value for j in range(2,5)], [4.0, 6.0, 10.0])
+
+        cache.invalidate(data)
+        self.assertEquals(len(cache), 0)
+        make_report('third').render(Workbook().add_sheet('third'), data)
+        self.assertEquals(len(calls), 2 * count)
+
+        # Equal data of other types is other data
+        def mean(values):
+            return sum(values) / len(values)
+        values = []
+        for data in ([[1, 2]], [[1.0, 2.0]]):
+            r = Report(calc_cache=cache)
+            r.cols.add_field('col 0')
+            r.cols.add_field('col 1')
+            r.cols.add_calc('mean', mean)
+            book = Workbook()
+            r.render(book.add_sheet('mean'), data)
+            compiled_report = StringIO()
+            book.save(compiled_report)
+            values.append(xlrd.open_workbook(file_contents=compiled_report.getvalue()).sheet_by_index(0).cell(1, 2).value)
+        self.assertEquals(values, [1.0, 1.5])
+
+        # Datasets are kept as digests, data of other types is not cached
+        cache = AggregateCache(datasets=2)
+        self.assertEquals(cache.dataset([(1, 'ab')]), cache.dataset([[1, ''.join(['a', 'b'])]]))
+        self.assertNotEquals(cache.dataset([[1, 'ab']]), cache.dataset([[1, u'ab']]))
+        self.assertEquals(cache.dataset([[Decimal('1.5'), date(2020, 1, 1)]]),
+                          cache.dataset([[Decimal('1.5'), date(2020, 1, 1)]]))
+        self.assertEquals(cache.dataset([[object()]]), None)
+        self.assertEquals([len(digest) for digest in cache._datasets], [32, 32])
+
+    def test_report_parallel(self):
+        """Test that calcs evaluated in worker processes match serial ones"""
+
+        def render(workers):
+            r = Report(workers=workers)
+            for i in range(3):
+                cs = r.cols.add_section('col %d' % i)
+                for j in range(3):
+                    cs.add_field('%d' % j)
+                cs.add_calc('', func=lambda x: max(x) - min(x))
+            r.cols.add_calc('total', func=sum)
+            for i in range(3):
+                rs = r.rows.add_section('row %d' % i)
+                for j in range(3):
+                    rs.add_field('%d' % j)
+                rs.add_calc('', func=lambda x: 1.0*sum(x)/len(x))
+            r.rows.add_calc('total', func=sum)
+
+            book = Workbook()
+            r.render(book.add_sheet('test worksheet'), [[i * j for j in range(9)] for i in range(9)])
+            compiled_report = StringIO()
+            book.save(compiled_report)
+            ws = xlrd.open_workbook(file_contents=compiled_report.getvalue()).sheet_by_index(0)
+            return [ws.row_values(i) for i in range(ws.nrows)]
+
+        self.assertEquals(render(2), render(None))
+
+    def test_composer(self):
+        """Test that composed workbook equals workbook rendered sheet by sheet"""
+
+        r = Report('composed')
+        r.cols.add_field('col 0')
+        r.cols.add_field('col 1')
+        r.cols.add_calc('total', sum)
+        r.rows.add_calc('total', sum)
+
+        data = [[1, 2], [3, 4]]
+        book = Workbook()
+        for name in ('first', 'second'):
+            ws = book.add_sheet(name)
+            r.render(ws, data)
+            r.render(ws, data)
+        expected = StringIO()
+        book.save(expected)
+
+        for workers in (None, 2):
+            composer = Composer(workers=workers)
+            for name in ('first', 'second'):
+                composer.add(r, data, name)
+                composer.add(r, data, name)
+            compiled_report = StringIO()
+            composer.save(compiled_report)
+            self.assertEquals(len(composer.styles), 2)
+
+            for index in range(2):
+                ws = xlrd.open_workbook(file_contents=compiled_report.getvalue()).sheet_by_index(index)
+                ews = xlrd.open_workbook(file_contents=expected.getvalue()).sheet_by_index(index)
+                self.assertEquals(ws.nrows, 12)
+                self.assertEquals([ws.row_values(i) for i in range(ws.nrows)],
+                                  [ews.row_values(i) for i in range(ews.nrows)])
+
+        # Merged cells take rows down to their last row, as in xlwt
+        from xlrep.composer import SheetBuffer
+        ws, buf = Workbook().add_sheet('merged'), SheetBuffer('merged')
+        for sheet in (ws, buf):
+            sheet.write(1, 0, 'cell')
+            sheet.write_merge(2, 5, 0, 1, 'merged')
+        self.assertEquals(buf.last_used_row, ws.last_used_row)
+
+    def test_layout(self):
+        """Test that saved and loaded layout renders the same report"""
+
+        avg = lambda x: 1.0*sum(x)/len(x)
+        style = easyxf('font: bold on; pattern: pattern solid, fore-colour rose;')
+
+        r = Report('layout', 'saved layout', memory_limit=12345)
+        hs = r.cols
+        c0 = hs.add_field('col 0', style=style)
+        hs.add_field('col 1', num_format='0.00')
+        hss = hs.add_section('col section 0', header_style=style)
+        hss.add_field('col 2_1')
+        hs.add_calc('col total', avg, fields_ignore=(c0,))
+        rs = r.rows
+        r0 = rs.add_field('row 0')
+        rs.add_field('row 1')
+        rs.add_calc('row total', sum, fields=(r0,), style=style)
+        r.add_rule(easyxf('font: colour red;'), above=4, cols=[hss])
+
+        def render(report):
+            book = Workbook()
+            report.render(book.add_sheet('test worksheet'), [[1, 2, 3], [4, 5, 6]])
+            compiled_report = StringIO()
+            book.save(compiled_report)
+            return compiled_report.getvalue()
+
+        self.assertRaises(ReportException, layout.dumps, r)
+        loaded = layout.loads(layout.dumps(r, funcs={'avg': avg}), funcs={'avg': avg})
+        self.assertEquals(render(loaded), render(r))
+        reloaded = layout.loads(layout.dumps(loaded, funcs={'avg': avg}), funcs={'avg': avg})
+        self.assertEquals(render(reloaded), render(r))
+
+        self.assertEquals(loaded.memory_limit, 12345)
+        calc = list(loaded.cols.get_calc_fields())[0]
+        self.assertTrue(calc.fields_ignore[0] is list(loaded.cols.get_fields())[0])
+        self.assertRaises(ReportException, layout.loads, layout.dumps(r, funcs={'avg': avg}))
+
+    def test_lazy_import(self):
+        """Test that xlwt is not imported with the package"""
+
+        script = 'import sys, xlrep; print "xlwt" in sys.modules; xlrep.Report; print "xlwt" in sys.modules'
+        out = Popen([sys.executable, '-c', script], stdout=PIPE,
+                    cwd=os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)).communicate()[0]
+        self.assertEquals(out.split(), ['False', 'True'])
+
+        # Star imports export the lazy names
+        script = ('from xlrep import *; from xlrep.styles import *; '
+                  'print Report.__name__, ReportException.__name__, styles.__name__, cell_style.__class__.__name__; '
+                  'print "LazyModule" in dir(), "sys" in dir()')
+        out = Popen([sys.executable, '-c', script], stdout=PIPE,
+                    cwd=os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)).communicate()[0]
+        self.assertEquals(out.split(), ['Report', 'ReportException', 'xlrep.styles', 'XFStyle', 'False', 'False'])
+
+    def test_service(self):
+        """Test render service in-process and over local socket"""
+
+        def slow(values):
+            time.sleep(0.2)
+            return sum(values)
+
+        def hang(values):
+            time.sleep(60)
+
+        def send(address, line):
+            conn = socket.create_connection(address)
+            try:
+                stream = conn.makefile('rwb')
+                stream.write(line + '\n')
+                stream.flush()
+                return json.loads(stream.readline())
+            finally:
+                conn.close()
+
+        r = Report('service')
+        r.cols.add_field('col 0')
+        r.cols.add_field('col 1')
+        r.rows.add_calc('total', sum)
+        s = Report('slow')
+        s.cols.add_field('col 0')
+        s.cols.add_calc('total', slow)
+        h = Report('hang')
+        h.cols.add_field('col 0')
+        h.cols.add_calc('total', hang)
+
+        service = RenderService(workers=2, max_pending=2, timeout=5)
+        service.register('report', r)
+        service.register('slow', s)
+        service.register('hang', h)
+        other = RenderService(workers=1)
+        other.register('other', r)
+        try:
+            address = service.serve()
+            for xls in (service.render('report', [[1, 2], [3, 4]]),
+                        request(address, 'report', [[1, 2], [3, 4]])):
+                ws = xlrd.open_workbook(file_contents=xls).sheet_by_index(0)
+                self.assertEquals(ws.row_values(4), [4.0, 6.0])
+
+            self.assertRaises(ReportException, request, address, 'unknown', [])
+            self.assertRaises(ReportException, service.render, 'report', [[1, 2, 3]])
+
+            jobs = [service.submit('slow', [[1]]) for i in range(2)]
+            self.assertRaises(ReportException, service.submit, 'slow', [[1]], block=False)
+            self.assertRaises(ReportException, jobs[0].result, 0.01)
+            for job in jobs:
+                job.result()
+
+            stats = service.stats()
+            self.assertEquals((stats['pending'], stats['completed'], stats['failed']), (0, 4, 1))
+            self.assertTrue(stats['timings'][-1]['render'] >= 0.2)
+
+            # Bad data doesn't take queue slots
+            for i in range(3):
+                self.assertEquals(send(address, '{"report": "report", "data": 5}')['status'], 'error')
+            self.assertEquals(service.stats()['pending'], 0)
+            self.assertEquals(send(address, '{"report": "report", "data": [[1, 2]]}')['status'], 'ok')
+
+            # Hanging job is stopped, its worker is restarted. New workers
+            # keep reports of their service when another one is started.
+            other.start()
+            start = time.time()
+            self.assertRaises(ReportException, service.render, 'hang', [[1]], timeout=0.3)
+            self.assertTrue(time.time() - start < 5)
+            stats = service.stats()
+            self.assertEquals((stats['pending'], stats['completed'], stats['timed_out']), (0, 5, 1))
+            for i in range(3):
+                service.render('report', [[1, 2]])
+            self.assertEquals(service.stats()['completed'], 8)
+            self.assertRaises(ReportException, service.render, 'other', [[1, 2]])
+            other.render('other', [[1, 2]])
+        finally:
+            service.shutdown()
+            other.shutdown()
+
+    def test_render_stream(self):
+        """Test that streamed report equals rendered one"""
+
+        def make_report():
+            r = Report('stream')
+            hs = r.cols
+            hs.add_field('col 0')
+            hs.add_field('col 1')
+            hss = hs.add_section('col section 0')
+            hss.add_field('col 2_1')
+            hss.add_calc('col total', sum)
+            hs.add_field('col 3')
+            hs.add_calc('col total 0', func=lambda x: 1.0*sum(x)/len(x))
+
+            rs = r.rows
+            rs.add_calc('row total 1', func=sum)
+            rs.add_field('row 0')
+            rss = rs.add_section('row section 0')
+            rss.add_field('row 1_1')
+            rss.add_field('row 1_2')
+            rss.add_calc('row total 0', func=max)
+            rs.add_field('row 2')
+            rs.add_field('row 3')
+            return r
+
+        def rows(count):
+            for i in range(count):
+                time.sleep(0.001)
+                yield [i, i * 2, i or None, i * 3]
+
+        def render(method, data):
+            book = Workbook()
+            ws = book.add_sheet('test worksheet')
+            method(make_report(), ws, data)
+            compiled_report = StringIO()
+            book.save(compiled_report)
+            ws = xlrd.open_workbook(file_contents=compiled_report.getvalue()).sheet_by_index(0)
+            return [ws.row_values(i) for i in range(ws.nrows)]
+
+        self.assertEquals(render(Report.render_stream, rows(5)), render(Report.render, list(rows(5))))
+        self.assertRaises(ReportException, render, Report.render_stream, rows(6))
+
+        def failing():
+            yield [1, 2, 3, 4]
+            raise ValueError('source failed')
+        self.assertRaises(ValueError, render, Report.render_stream, failing())
+
+        ws = Workbook().add_sheet('test worksheet')
+        plan = make_report().render_stream(ws, rows(5))
+        self.assertEquals((plan.mode, plan.rows, plan.cols), ('stream', 7, 6))
+        self.assertRaises(ReportException, make_report().plan, 5, mode='spill')
+        r = Report('fallback')
+        r.cols.add_field('col 0')
+        self.assertEquals(r.render_stream(ws, [[1], [2]], top=10).mode, 'memory')
+
+    def test_aggregates(self):
+        """Test sketch aggregators as calc functions"""
+
+        self.assertEquals(Median()(range(1, 6)), 3)
+        self.assertEquals(Quantile(1)([5, 1, 9]), 9)
+        self.assertEquals(Quantile(0.5)([]), None)
+        self.assertEquals(DistinctCount()([1, 2, 2, 3, 1.0]), 3)
+
+        values = [(i * 7919) % 10007 for i in range(20000)]
+        quantile, digest = Quantile(0.9), Quantile(0.9).start()
+        halves = quantile.start(), quantile.start()
+        for i, value in enumerate(values):
+            quantile.add(halves[i % 2], value)
+        self.assertTrue(abs(quantile.result(quantile.merge(*halves)) - 0.9 * 10007) < 0.01 * 10007)
+        self.assertTrue(abs(DistinctCount()(values) - 10007) < 0.05 * 10007)
+
+        # Aggregators are fed incrementally by render_stream
+        r = Report()
+        r.cols.add_field('col 0')
+        r.cols.add_field('col 1')
+        r.cols.add_calc('distinct', DistinctCount())
+        for i in range(101):
+            r.rows.add_field('row %d' % i)
+        r.rows.add_calc('median', Median())
+        r.rows.add_calc('sum', Sum())
+
+        book = Workbook()
+        r.render_stream(book.add_sheet('test worksheet'), ([i, i % 10] for i in range(101)))
+        compiled_report = StringIO()
+        book.save(compiled_report)
+        ws = xlrd.open_workbook(file_contents=compiled_report.getvalue()).sheet_by_index(0)
+        self.assertEquals(ws.row_values(102, 1)[::2], [50.0, 2.0])
+        self.assertTrue(abs(ws.cell(102, 2).value - 4) < 0.5)
+        self.assertEquals(ws.row_values(103, 1), [5050.0, 450.0, 2.0])
+        self.assertEquals(ws.cell(2, 3).value, 1.0)
+
+    def test_rules(self):
+        """Test conditional styles"""
+
+        red = easyxf('font: colour red;')
+        band = easyxf('pattern: pattern solid, fore-colour gray25;')
+        r = Report()
+        cs = r.cols
+        c0 = cs.add_field('col 0')
+        cs.add_field('col 1')
+        cs.add_calc('total', sum)
+        for i in range(4):
+            r.rows.add_field('row %d' % i)
+        r.add_rule(red, below=0)
+        r.add_rule(easyxf('font: bold on;'), test=lambda value: value == 7, cols=[c0])
+        r.add_band(band)
+
+        book = Workbook()
+        r.render(book.add_sheet('test worksheet'), [[-1, 7], [7, -2], [1, 2], [3, -4]])
+        compiled_report = StringIO()
+        book.save(compiled_report)
+        book = xlrd.open_workbook(file_contents=compiled_report.getvalue(), formatting_info=True)
+        ws = book.sheet_by_index(0)
+
+        def formatting(i, j):
+            xf = book.xf_list[ws.cell_xf_index(i + 1, j + 1)]
+            font = book.font_list[xf.font_index]
+            return (font.colour_index == 10, font.bold == 1, xf.background.fill_pattern == 1)
+
+        self.assertEquals([formatting(0, j) for j in range(3)],
+                          [(True, False, False), (False, False, False), (False, False, False)])
+        self.assertEquals([formatting(1, j) for j in range(3)],
+                          [(False, True, True), (True, False, True), (False, False, True)])
+        self.assertEquals(formatting(3, 2), (True, False, True))
+        self.assertEquals(ws.cell(4, 3).value, -1.0)
+
+        # Rule keeps alignment and number format of the cell
+        r = Report()
+        r.cols.add_field('col 0', style=easyxf('align: horiz center', num_format_str='0.00'))
+        r.rows.add_field('row 0')
+        r.rows.add_field('row 1')
+        r.add_rule(red, below=0)
+        book = Workbook()
+        r.render(book.add_sheet('test worksheet'), [[1], [-1]])
+        compiled_report = StringIO()
+        book.save(compiled_report)
+        book = xlrd.open_workbook(file_contents=compiled_report.getvalue(), formatting_info=True)
+        ws = book.sheet_by_index(0)
+        for i in (1, 2):
+            xf = book.xf_list[ws.cell_xf_index(i, 1)]
+            self.assertEquals(book.format_map[xf.format_key].format_str, '0.00')
+            self.assertEquals(xf.alignment.hor_align, 2)
+            self.assertEquals(book.font_list[xf.font_index].colour_index == 10, i == 2)
+
+        # Bands follow drawn rows
+        r = Report()
+        r.cols.add_field('col 0')
+        r.rows.add_field('row 0')
+        hidden = r.rows.add_section('hidden', expand=False)
+        hidden.add_field('hidden 0')
+        hidden.add_calc('total', sum)
+        r.rows.add_field('row 1')
+        r.rows.add_field('row 2')
+        r.add_band(band)
+        book = Workbook()
+        r.render(book.add_sheet('test worksheet'), [[1], [2], [3], [4]])
+        compiled_report = StringIO()
+        book.save(compiled_report)
+        book = xlrd.open_workbook(file_contents=compiled_report.getvalue(), formatting_info=True)
+        ws = book.sheet_by_index(0)
+        self.assertEquals([book.xf_list[ws.cell_xf_index(i, 2)].background.fill_pattern for i in range(1, 5)],
+                          [0, 1, 0, 1])
+
+    def test_providers(self):
+        """Test that section providers are called only for needed rows"""
+
+        class Provider(object):
+            def __init__(self, rows, totals=None):
+                self.rows = rows
+                self.totals = totals
+                self.calls = 0
+            def __call__(self, fields):
+                self.calls += 1
+                return self.rows[:len(fields)]
+
+        class Aggregating(Provider):
+            def aggregate(self, calc):
+                return self.totals
+
+        def make_report(north, south, expand=False):
+            r = Report()
+            r.cols.add_field('col 0')
+            r.cols.add_field('col 1')
+            r.cols.add_calc('total', sum)
+            r.rows.add_field('row 0')
+            ns = r.rows.add_section('north', provider=north, expand=expand)
+            ns.add_field('north 0')
+            ns.add_field('north 1')
+            ns.add_calc('north total', sum)
+            ss = r.rows.add_section('south', provider=south)
+            ss.add_field('south 0')
+            ss.add_calc('south total', max)
+            return r
+
+        def render(report):
+            book = Workbook()
+            report.render(book.add_sheet('test worksheet'), [[1, 2]])
+            compiled_report = StringIO()
+            book.save(compiled_report)
+            ws = xlrd.open_workbook(file_contents=compiled_report.getvalue()).sheet_by_index(0)
+            return [ws.row_values(i) for i in range(ws.nrows)]
+
+        north, south = Aggregating([[1, 1], [2, 2]], [10, 20]), Provider([[5, 6]])
+        self.assertEquals(render(make_report(north, south)), [
+            ['', '', 'col 0', 'col 1', 'total'],
+            ['row 0', '', 1.0, 2.0, 3.0],
+            ['north', 'north total', 10.0, 20.0, 30.0],
+            ['south', 'south 0', 5.0, 6.0, 11.0],
+            ['', 'south total', 5.0, 6.0, 11.0]])
+        self.assertEquals((north.calls, south.calls), (0, 1))
+
+        # Without aggregate the rows are loaded for the calc, but not drawn
+        north = Provider([[1, 1], [2, 2]])
+        self.assertEquals(render(make_report(north, south))[2], ['north', 'north total', 3.0, 3.0, 6.0])
+        self.assertEquals(north.calls, 1)
+
+        # Expanded section is loaded and drawn, aggregate is not used
+        north = Aggregating([[1, 1], [2, 2]], [10, 20])
+        self.assertEquals(len(render(make_report(north, south, expand=True))), 7)
+        self.assertEquals(north.calls, 1)
+
+        self.assertRaises(ReportException, render, make_report(Provider([[1, 1]]), south))
+
+    def test_preview(self):
+        """Test that preview draws first rows and totals over all data"""
+
+        r = Report('preview')
+        r.cols.add_field('col 0')
+        r.cols.add_field('col 1')
+        r.cols.add_calc('total', sum)
+        rs = r.rows.add_section('rows')
+        for i in range(5):
+            rs.add_field('row %d' % i)
+        rs.add_calc('max', max)
+        r.rows.add_calc('total', sum)
+
+        def render(preview):
+            book = Workbook()
+            r.render(book.add_sheet('test worksheet'), [[i, i * 10] for i in range(5)], preview=preview)
+            compiled_report = StringIO()
+            book.save(compiled_report)
+            ws = xlrd.open_workbook(file_contents=compiled_report.getvalue()).sheet_by_index(0)
+            return [ws.row_values(i) for i in range(ws.nrows)]
+
+        full = render(None)
+        self.assertEquals(render(2), full[:4] + full[-2:])
+        self.assertEquals(render(2)[-2:], [['', 'max', 4.0, 40.0, 44.0], ['total', '', 10.0, 100.0, 110.0]])
+        self.assertEquals(render(0), full[:2] + [['rows'] + full[-2][1:], full[-1]])
+        self.assertEquals(render(10), full)
+
+    def test_memory_limit(self):
+        """Test that report over memory limit equals report rendered in memory"""
+
+        def make_report(row_fields=True, memory_limit=None):
+            r = Report('memory', memory_limit=memory_limit)
+            r.cols.add_field('col 0')
+            r.cols.add_field('col 1')
+            r.cols.add_calc('total', sum)
+            if row_fields:
+                rs = r.rows.add_section('rows')
+                for i in range(5):
+                    rs.add_field('row %d' % i)
+                rs.add_calc('min', min)
+                rs.add_calc('avg', lambda x: 1.0*sum(x)/len(x))
+            r.rows.add_calc('total', sum)
+            return r
+
+        def render(report, data, transpose=False):
+            book = Workbook()
+            report.render(book.add_sheet('test worksheet'), data, transpose)
+            compiled_report = StringIO()
+            book.save(compiled_report)
+            ws = xlrd.open_workbook(file_contents=compiled_report.getvalue()).sheet_by_index(0)
+            return [ws.row_values(i) for i in range(ws.nrows)]
+
+        data = [[i, i * 10] for i in range(5)]
+        for row_fields in (True, False):
+            expected = render(make_report(row_fields), data)
+            self.assertEquals(render(make_report(row_fields, 1), data), expected)
+            self.assertEquals(render(make_report(row_fields, 1), iter(data)), expected)
+            self.assertEquals(render(make_report(row_fields, 1), zip(*data), True), expected)
+            self.assertEquals(render(make_report(row_fields, 10000), data), expected)
+
+        # Spilled in blocks
+        block, Report.SPILL_BLOCK = Report.SPILL_BLOCK, 2
+        try:
+            self.assertEquals(render(make_report(False, 1), data), render(make_report(False), data))
+        finally:
+            Report.SPILL_BLOCK = block
+        self.assertRaises(ReportException, render, make_report(True, 1), data[:4])
+
+    def test_deep_headers(self):
+        """Test deeply nested sections and header layout cache"""
+
+        r = Report()
+        r.cols.add_field('col 0')
+        section = r.rows
+        for i in range(1500):
+            section = section.add_section(collapse=False)
+            section.add_field('row %d' % i)
+        section.add_calc('total', sum)
+
+        def render(data):
+            book = Workbook()
+            r.render(book.add_sheet('test worksheet'), data)
+            compiled_report = StringIO()
+            book.save(compiled_report)
+            ws = xlrd.open_workbook(file_contents=compiled_report.getvalue()).sheet_by_index(0)
+            return [ws.row_values(i) for i in range(ws.nrows)]
+
+        values = render([[i] for i in range(1500)])
+        self.assertEquals(len(values), 1502)
+        self.assertEquals(values[-2:], [['row 1499', 1499.0], ['total', 1499.0]])
+
+        # Report rendered again reuses its layout
+        import xlrep.reports
+        calls = []
+        head_render = xlrep.reports._head_render
+        def counted(*args, **kwargs):
+            calls.append(args[0])
+            return head_render(*args, **kwargs)
+        xlrep.reports._head_render = counted
+        try:
+            self.assertEquals(render([[i] for i in range(1500)]), values)
+            self.assertEquals(calls, [])
+            # so does a report with fake rows
+            f = Report()
+            f.cols.add_field('col 0')
+            for i in range(2):
+                f.render(Workbook().add_sheet('test worksheet'), [[1], [2]])
+            self.assertEquals(calls, [f.cols])
+        finally:
+            xlrep.reports._head_render = head_render
+
+        # Cached layout is dropped when sections change
+        section.add_field('row 1500')
+        values = render([[i] for i in range(1501)])
+        self.assertEquals(values[-2:], [['total', 2999.0], ['row 1500', 1500.0]])
+
+    def test_series(self):
+        """Test running and windowed series fields"""
+
+        def make_report():
+            r = Report()
+            for i in range(5):
+                r.cols.add_field('day %d' % i)
+            r.cols.add_calc('total', sum)
+            sales = r.rows.add_field('sales')
+            cost = r.rows.add_field('cost')
+            r.rows.add_calc('max', max)
+            total = r.rows.add_series('cumulative', sales)
+            r.rows.add_series('average', sales, 'mean', 2)
+            r.rows.add_series('delta', cost, 'delta')
+            r.rows.add_series('sum of 3', total, 'sum', 3)
+            cum = r.cols.add_series('cumulative', r.cols.add_field('day 5'))
+            r.cols.add_series('growth', cum, 'delta')
+            return r
+
+        def render(method, data):
+            book = Workbook()
+            method(make_report(), book.add_sheet('test worksheet'), data)
+            compiled_report = StringIO()
+            book.save(compiled_report)
+            ws = xlrd.open_workbook(file_contents=compiled_report.getvalue()).sheet_by_index(0)
+            return [ws.row_values(i) for i in range(ws.nrows)]
+
+        data = [[1, 2, None, 4, 5, 10], [3, 3, 3, 3, 3, 20]]
+        values = render(Report.render, data)
+        self.assertEquals(values, [
+            ['', 'day 0', 'day 1', 'day 2', 'day 3', 'day 4', 'total', 'day 5', 'cumulative', 'growth'],
+            ['sales', 1.0, 2.0, '', 4.0, 5.0, 22.0, 10.0, 10.0, ''],
+            ['cost', 3.0, 3.0, 3.0, 3.0, 3.0, 35.0, 20.0, 30.0, 20.0],
+            ['max', 3.0, 3.0, 3.0, 4.0, 5.0, 38.0, 20.0, '', ''],
+            ['cumulative', 1.0, 3.0, 3.0, 7.0, 12.0, '', 22.0, '', ''],
+            ['average', '', 1.5, 2.0, 4.0, 4.5, '', 7.5, '', ''],
+            ['delta', '', 0.0, 0.0, 0.0, 0.0, '', 17.0, '', ''],
+            ['sum of 3', '', '', 7.0, 13.0, 22.0, '', 41.0, '', '']])
+        self.assertEquals(render(Report.render_stream, iter(data)), values)
+        self.assertRaises(ReportException, make_report().rows.add_series, 'bad', None, 'median')
+        self.assertRaises(ReportException, make_report().rows.add_series, 'bad', None)
+
+        # Source should be a field of the same layout
+        r = make_report()
+        r.rows.add_series('wrong', r.cols.get_fields().next())
+        self.assertRaises(ReportException, r.render, Workbook().add_sheet('test worksheet'), data)
+        r = make_report()
+        r.cols.add_series('wrong', Report().rows.add_field('other'))
+        self.assertRaises(ReportException, r.render_stream, Workbook().add_sheet('test worksheet'), iter(data))
+        self.assertEquals(render(Report.render, data), values)
+
+    def test_plan(self):
+        """Test render cost estimates and render mode selection"""
+        from xlrep.plan import XLS_STYLES
+
+        def make_report(memory_limit=None):
+            r = Report('plan', memory_limit=memory_limit)
+            for i in range(3):
+                r.cols.add_field('col %d' % i)
+            r.cols.add_calc('total', sum)
+            rs = r.rows.add_section('rows')
+            for i in range(4):
+                rs.add_field('row %d' % i)
+            rs.add_calc('avg', lambda x: 1.0*sum(x)/len(x))
+            r.rows.add_series('cumulative', r.rows.add_calc('total', sum))
+            return r
+
+        plan = make_report().plan()
+        self.assertEquals((plan.mode, plan.rows, plan.cols, plan.cells), ('memory', 7, 4, 28))
+        self.assertEquals((plan.calc_cells, plan.depth, plan.styles), (16, 3, 1))
+        self.assertEquals(plan.memory, {'memory': 28 * Report.CELL_SIZE, 'stream': 6 * 4 * Report.CELL_SIZE})
+        self.assertTrue(plan.fits)
+
+        # Memory mode is chosen while it fits memory_limit
+        data = [[i, i * 10, i * 100] for i in range(4)]
+        book = Workbook()
+        self.assertEquals(make_report(28 * Report.CELL_SIZE).render(book.add_sheet('memory'), data).mode, 'memory')
+        plan = make_report(28 * Report.CELL_SIZE - 1).render(book.add_sheet('stream'), data)
+        self.assertEquals((plan.mode, plan.peak), ('stream', 24 * Report.CELL_SIZE))
+
+        # Render mode doesn't change number formats of cells sharing a style
+        def formats(memory_limit):
+            bold = easyxf('font: bold on;')
+            r = Report(memory_limit=memory_limit)
+            r.cols.add_field('col 0')
+            r.rows.add_calc('total', sum, style=bold)
+            r.rows.add_field('row 0', style=bold, num_format='0.00')
+            book = Workbook()
+            mode = r.render(book.add_sheet('test worksheet'), [[1]]).mode
+            compiled_report = StringIO()
+            book.save(compiled_report)
+            book = xlrd.open_workbook(file_contents=compiled_report.getvalue(), formatting_info=True)
+            ws = book.sheet_by_index(0)
+            return [mode] + [book.format_map[book.xf_list[ws.cell_xf_index(i, 1)].format_key].format_str
+                             for i in (1, 2)] + [bold.num_format_str]
+        self.assertEquals(formats(None), ['memory', 'General', '0.00', 'General'])
+        self.assertEquals(formats(1), ['stream', 'General', '0.00', 'General'])
+
+        # Data shape is needed for layouts without fields
+        r = Report(memory_limit=1)
+        r.cols.add_field('col')
+        r.rows.add_calc('total', sum)
+        plan = r.plan()
+        spill = (2 + Report.SPILL_BLOCK) * Report.CELL_SIZE     # row, sum and a block of data
+        self.assertEquals((plan.mode, plan.rows, plan.cells, plan.memory), ('spill', None, None, {'memory': None, 'spill': spill}))
+        plan = r.plan(rows=70000)
+        self.assertEquals((plan.rows, plan.calc_cells, plan.mode, plan.peak), (70001, 1, 'spill', spill))
+        self.assertFalse(plan.fits)
+        self.assertEquals(plan.as_dict()['problems'], plan.problems)
+        self.assertEquals(len(plan.problems), 2)        # rows and memory
+
+        # Styles are bounded by cells
+        r = Report()
+        for i in range(100):
+            r.rows.add_field(style=XFStyle())
+            r.cols.add_field(num_format='0.%s' % ('0' * i))
+        self.assertEquals(r.plan().styles, 100 * 100)
+        self.assertFalse(r.plan().fits)
+        self.assertTrue(r.plan().styles > XLS_STYLES)
+
+        # Preview is rendered in memory
+        self.assertEquals(make_report(1).plan(preview=2).memory.keys(), ['memory'])
+
+    def test_trace(self):
+        """Test tracing of calc field calls"""
+
+        def slow(values):
+            time.sleep(0.01)
+            return len(values)
+
+        def make_report(trace, workers=None):
+            r = Report(trace=trace, workers=workers)
+            for i in range(3):
+                r.cols.add_field('col %d' % i)
+            r.cols.add_calc('slow', slow)
+            rs = r.rows.add_section('rows')
+            for i in range(4):
+                rs.add_field('row %d' % i)
+            rs.add_calc('total', sum)
+            rs.add_calc('mean', lambda x: 1.0*sum(x)/len(x))
+            return r
+
+        data = [[1, None, 3], [4, 5, 6], [None, None, 9], [10, 11, 12]]
+        for workers in (None, 2):
+            trace = CalcTrace()
+            make_report(trace, workers).render(Workbook().add_sheet('test worksheet'), data)
+            stats = trace.stats()
+            self.assertEquals(stats[0]['field'], 'slow')
+            self.assertEquals(sorted((s['field'], s['section'], s['calls']) for s in stats),
+                [('mean', 'rows', 3), ('slow', '', 6), ('total', 'rows', 3)])
+            # 4 data rows and 2 calc rows of 3 cells, 3 None values in data rows
+            # are filtered out before the calls
+            self.assertEquals((stats[0]['values'], stats[0]['max_values'], stats[0]['filtered']), (15, 3, 3))
+            self.assertTrue(stats[0]['total'] >= 0.06 and stats[0]['max'] >= 0.01)
+        self.assertEquals([s['field'] for s in trace.stats('field')], ['mean', 'slow', 'total'])
+        self.assertEquals(json.loads(trace.as_json('calls'))[0]['calls'], 6)
+        self.assertEquals(trace.table().splitlines()[1].split()[:2], ['slow', '6'])
+        self.assertRaises(ValueError, trace.stats, 'unknown')
+
+        # Row by row rendering: sum is fed a row at a time
+        trace = CalcTrace()
+        r = make_report(trace)
+        r.memory_limit = 1
+        r.render(Workbook().add_sheet('test worksheet'), data)
+        self.assertEquals(dict((s['field'], s['calls']) for s in trace.stats()), {'slow': 6, 'total': 4, 'mean': 3})
+
+        # Errors name the calc field
+        r = Report()
+        r.cols.add_field('col')
+        r.rows.add_section('rows').add_field('row')
+        r.rows.add_calc('broken', lambda x: x[0] / 0)
+        try:
+            r.render(Workbook().add_sheet('test worksheet'), [[1]])
+        except ReportException, e:
+            self.assertTrue('calc field broken' in str(e))
+        else:
+            self.fail('ReportException is not raised')
+
 
 def suite():
     suite = unittest.TestSuite()
@@ -15,5 +15,23 @@
 
 """
 
-from reports import Report, ReportException
-import styles
+import sys
+from lazy import LazyModule, attribute, submodule
+
+# Submodules (and xlwt) are imported on first use
+_lazy = {
+    'Report':           attribute('xlrep.reports', 'Report'),
+    'ReportException':  attribute('xlrep.reports', 'ReportException'),
+    'AggregateCache':   attribute('xlrep.cache', 'AggregateCache'),
+    'CalcTrace':        attribute('xlrep.trace', 'CalcTrace'),
+    'Composer':         attribute('xlrep.composer', 'Composer'),
+    'SheetBuffer':      attribute('xlrep.composer', 'SheetBuffer'),
+    'RenderService':    attribute('xlrep.service', 'RenderService'),
+    'styles':           submodule('xlrep.styles'),
+    'layout':           submodule('xlrep.layout'),
+    'plan':             submodule('xlrep.plan'),
+}
+
+__all__ = sorted(_lazy)
+
+LazyModule(sys.modules[__name__], _lazy)
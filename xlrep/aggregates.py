@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+from math import asin, log, pi, sin
+
+"""
+Incremental aggregation functions for calc fields.
+
+An aggregator can be used as a calc function like any other function:
+
+    section.add_calc('Median', Quantile(0.5))
+    section.add_calc('Customers', DistinctCount())
+
+Besides it can be fed value by value and partial results can be merged:
+
+    state = agg.start()
+    for value in values:
+        state = agg.add(state, value)
+    total = agg.result(agg.merge(state, other_state))
+
+Report.render_stream feeds aggregators incrementally, so totals over tall
+reports don't keep all values in memory. Quantile and DistinctCount use
+bounded memory sketches and return approximate results.
+
+"""
+
+class Aggregator(object):
+    """Base class of incremental aggregation functions"""
+    def start(self):
+        """Returns empty state"""
+        raise NotImplementedError
+
+    def add(self, state, value):
+        """Adds value to the state. Returns new state."""
+        raise NotImplementedError
+
+    def merge(self, state, other):
+        """Merges two states. Returns new state."""
+        raise NotImplementedError
+
+    def result(self, state):
+        """Returns aggregated value"""
+        return state
+
+    def __call__(self, values):
+        state = self.start()
+        for value in values:
+            state = self.add(state, value)
+        return self.result(state)
+
+class Sum(Aggregator):
+    """Sum of values"""
+    def start(self):
+        return 0
+
+    def add(self, state, value):
+        return state + value
+
+    def merge(self, state, other):
+        return state + other
+
+class Count(Aggregator):
+    """Number of values"""
+    def start(self):
+        return 0
+
+    def add(self, state, value):
+        return state + 1
+
+    def merge(self, state, other):
+        return state + other
+
+class Min(Aggregator):
+    """Min value. None for empty sequence."""
+    def start(self):
+        return None
+
+    def add(self, state, value):
+        return value if state is None or value < state else state
+
+    def merge(self, state, other):
+        return state if other is None else self.add(state, other)
+
+class Max(Aggregator):
+    """Max value. None for empty sequence."""
+    def start(self):
+        return None
+
+    def add(self, state, value):
+        return value if state is None or value > state else state
+
+    def merge(self, state, other):
+        return state if other is None else self.add(state, other)
+
+class Mean(Aggregator):
+    """Arithmetic mean. None for empty sequence."""
+    def start(self):
+        return (0, 0)
+
+    def add(self, state, value):
+        return (state[0] + value, state[1] + 1)
+
+    def merge(self, state, other):
+        return (state[0] + other[0], state[1] + other[1])
+
+    def result(self, state):
+        if not state[1]:
+            return None
+        return 1.0 * state[0] / state[1]
+
+class _Digest(object):
+    """t-digest state: sorted centroids plus unsorted buffer of new values"""
+    __slots__ = ['means', 'weights', 'buffer', 'min', 'max']
+
+    def __init__(self):
+        self.means, self.weights, self.buffer = [], [], []
+        self.min = self.max = None
+
+class Quantile(Aggregator):
+    """Approximate quantile (merging t-digest).
+
+    Memory is O(compression) whatever the number of values. The error is
+    smallest at the tails and largest near the median: with the default
+    compression 100 the rank error is typically below 1% near the median
+    and below 0.1% for q < 0.01 or q > 0.99. Min and max are exact.
+    Higher compression gives proportionally smaller error.
+
+    Keyword arguments:
+    q --            quantile, 0 <= q <= 1 (0.5 is median)
+    compression --  digest size parameter
+
+    """
+    def __init__(self, q=0.5, compression=100):
+        if not 0 <= q <= 1:
+            raise ValueError('Quantile should be in [0, 1]: %s' % q)
+        self.q = q
+        self.compression = compression
+
+    def start(self):
+        return _Digest()
+
+    def add(self, state, value):
+        state.buffer.append(value)
+        if len(state.buffer) >= 5 * self.compression:
+            self._compress(state)
+        return state
+
+    def merge(self, state, other):
+        self._compress(other)
+        state.buffer.extend(zip(other.means, other.weights))
+        for value in (other.min, other.max):
+            if value is not None:
+                state.min = value if state.min is None else min(state.min, value)
+                state.max = value if state.max is None else max(state.max, value)
+        self._compress(state)
+        return state
+
+    def result(self, state):
+        self._compress(state)
+        means, weights = state.means, state.weights
+        if not means:
+            return None
+        if len(means) == 1:
+            return means[0]
+        total = sum(weights)
+        rank = self.q * total
+        # Centroid i covers ranks around its middle; interpolate between middles
+        middle = weights[0] / 2.0
+        if rank <= middle:
+            return _between(state.min, means[0], rank / middle)
+        for i in range(1, len(means)):
+            step = (weights[i - 1] + weights[i]) / 2.0
+            if rank <= middle + step:
+                return _between(means[i - 1], means[i], (rank - middle) / step)
+            middle += step
+        return _between(means[-1], state.max, (rank - middle) / (total - middle))
+
+    def _compress(self, state):
+        """Merges buffered values into centroids"""
+        if not state.buffer:
+            return
+        items = []
+        for item in state.buffer:
+            if type(item) is tuple:
+                items.append(item)
+            else:
+                items.append((item, 1))
+                state.min = item if state.min is None or item < state.min else state.min
+                state.max = item if state.max is None or item > state.max else state.max
+        items.extend(zip(state.means, state.weights))
+        items.sort()
+        state.buffer = []
+
+        total = float(sum(w for m, w in items))
+        means, weights = [], []
+        mean, weight = items[0]
+        done = 0
+        limit = self._limit(0)
+        for m, w in items[1:]:
+            if (done + weight + w) / total <= limit:
+                mean += (m - mean) * w / float(weight + w)
+                weight += w
+            else:
+                means.append(mean)
+                weights.append(weight)
+                done += weight
+                limit = self._limit(done / total)
+                mean, weight = m, w
+        means.append(mean)
+        weights.append(weight)
+        state.means, state.weights = means, weights
+
+    def _limit(self, q):
+        """Max quantile a centroid started at q may cover (k1 scale function)"""
+        k = self.compression / (2 * pi) * asin(2 * q - 1) + 1
+        if k >= self.compression / 4.0:
+            return 1.0
+        return (sin(k * 2 * pi / self.compression) + 1) / 2
+
+def _between(a, b, t):
+    return a + (b - a) * max(0.0, min(1.0, t))
+
+class Median(Quantile):
+    """Approximate median. See Quantile."""
+    def __init__(self, compression=100):
+        Quantile.__init__(self, 0.5, compression)
+
+_MASK = (1 << 64) - 1
+
+def _hash64(value):
+    """Well mixed 64-bit hash (splitmix64 finalizer over hash())"""
+    x = hash(value) & _MASK
+    x ^= x >> 33
+    x = (x * 0xff51afd7ed558ccd) & _MASK
+    x ^= x >> 33
+    x = (x * 0xc4ceb9fe1a85ec53) & _MASK
+    x ^= x >> 33
+    return x
+
+class DistinctCount(Aggregator):
+    """Approximate number of distinct values (HyperLogLog).
+
+    Uses 2**precision one-byte registers whatever the number of values.
+    The standard error is 1.04 / sqrt(2**precision): 1.6% for the default
+    precision 12 (4 KB), 0.8% for 14; about 95% of estimates are within
+    two standard errors. Values are hashed with hash(), so equal values
+    (e.g. 1 and 1.0) are counted once.
+
+    Keyword arguments:
+    precision --    number of index bits, 4..16
+
+    """
+    def __init__(self, precision=12):
+        if not 4 <= precision <= 16:
+            raise ValueError('Precision should be in [4, 16]: %s' % precision)
+        self.precision = precision
+        self.m = 1 << precision
+        self.alpha = {16: 0.673, 32: 0.697, 64: 0.709}.get(self.m, 0.7213 / (1 + 1.079 / self.m))
+
+    def start(self):
+        return bytearray(self.m)
+
+    def add(self, state, value):
+        h = _hash64(value)
+        index = h >> (64 - self.precision)
+        rest = (h << self.precision) & _MASK
+        rank = 1
+        while rank <= 64 - self.precision and not rest & (1 << 63):
+            rest <<= 1
+            rank += 1
+        if rank > state[index]:
+            state[index] = rank
+        return state
+
+    def merge(self, state, other):
+        for i, rank in enumerate(other):
+            if rank > state[i]:
+                state[i] = rank
+        return state
+
+    def result(self, state):
+        m = self.m
+        estimate = self.alpha * m * m / sum(2.0 ** -rank for rank in state)
+        zeros = state.count('\x00')
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * log(float(m) / zeros)
+        return int(round(estimate))
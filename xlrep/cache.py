@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+from collections import OrderedDict
+from datetime import date, datetime, time, timedelta
+from decimal import Decimal
+from hashlib import sha256
+from itertools import count
+from marshal import dumps
+
+"""
+Shared cache of calc field results.
+
+Several reports are often rendered over the same data matrix (different
+captions, styles or section groupings). Reports that share an AggregateCache
+compute each aggregate over the same data cells only once.
+
+"""
+
+_missing = object()
+
+# Types of values that have a canonical repr
+_scalars = frozenset([type(None), bool, int, long, float, str, unicode,
+                      Decimal, date, datetime, time, timedelta])
+
+def _digest(data):
+    """Returns digest of the data content or None if the data contains
+    values of other types than _scalars. Values are serialized with their
+    types: equal values of different types give different aggregates
+    (e.g. 3/2 and 3.0/2).
+
+    Rows are serialized by marshal (version 0 has no references to
+    interned strings, so equal rows give equal bytes). Rows it can't
+    serialize (Decimal, dates) are serialized as reprs of (type, value)
+    pairs.
+
+    """
+    digest = sha256()
+    for row in data:
+        try:
+            digest.update('m' + dumps(list(row), 0))
+        except ValueError:
+            types = map(type, row)
+            if not _scalars.issuperset(types):
+                return None
+            digest.update('r' + repr(zip(types, row)))
+    return digest.digest()
+
+class AggregateCache(object):
+    """Bounded LRU cache of aggregated values.
+
+    Results are keyed by (dataset, axis, data cells, aggregation function),
+    where data cells are positions in the input data matrix, so the key
+    doesn't depend on the report layout.
+
+    Calc values over other calc cells are cached as well: they are keyed
+    by the keys of the cells they depend on. Data cells are compared with
+    their types, so 1 and 1.0 (or True) are different data.
+
+    Datasets are remembered by a digest of their content, the data itself
+    is not kept. Data with values of other types than numbers, strings,
+    None, Decimal and date/time values is not cached.
+
+    """
+    def __init__(self, size=100000, datasets=16):
+        """Creates a cache.
+
+        Keyword arguments:
+        size --         max number of cached values
+        datasets --     max number of remembered datasets. When a dataset
+                        is forgotten all its values are dropped.
+
+        """
+        self.size = size
+        self.datasets = datasets
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._datasets = OrderedDict()      # digest -> token
+        self._counter = count()
+
+    def __len__(self):
+        return len(self._items)
+
+    def dataset(self, data):
+        """Returns a token that identifies data content or None if
+        the data can't be cached (e.g. contains objects or lists).
+
+        Keyword arguments:
+        data --     data matrix (list of rows)
+
+        """
+        digest = _digest(data)
+        if digest is None:
+            return None
+        token = self._datasets.pop(digest, None)
+        if token is None:
+            token = next(self._counter)
+        self._datasets[digest] = token
+        while len(self._datasets) > self.datasets:
+            self._forget(next(iter(self._datasets)))
+        return token
+
+    def get(self, key, default=None):
+        """Returns cached value or default"""
+        value = self._items.pop(key, _missing)
+        if value is _missing:
+            self.misses += 1
+            return default
+        self._items[key] = value
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        """Stores value. Evicts least recently used values if
+        the cache is full."""
+        self._items.pop(key, None)
+        self._items[key] = value
+        while len(self._items) > self.size:
+            self._items.popitem(last=False)
+
+    def invalidate(self, data=None):
+        """Drops cached values.
+
+        Keyword arguments:
+        data --     drop only values computed over this data matrix.
+                    If not specified drops everything.
+
+        """
+        if data is None:
+            self._items.clear()
+            self._datasets.clear()
+            return
+        digest = _digest(data)
+        if digest in self._datasets:
+            self._forget(digest)
+
+    def _forget(self, digest):
+        """Drops dataset and all its values"""
+        token = self._datasets.pop(digest)
+        for key in [key for key in self._items if key[0] == token]:
+            del self._items[key]
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+import sys
+from multiprocessing import Pool
+from xlwt import Workbook
+from styles import style_key
+
+"""
+Multi-report workbook composer.
+
+Composer takes a list of placements (report, data, sheet, position),
+builds every sheet into a SheetBuffer (optionally in worker processes)
+and then writes all sheets into one workbook through a single
+deduplicated style table.
+
+Example:
+    composer = Composer(workers=4)
+    composer.add(sales_report, sales, 'Sales')
+    composer.add(totals_report, totals, 'Sales')      # below sales report
+    composer.add(stock_report, stock, 'Stock', top=2, left=1)
+    composer.save('monthly.xls')
+
+"""
+
+class _Props(object):
+    """Records row or column properties"""
+    def __init__(self):
+        self.__dict__['_attrs'] = []
+
+    def __setattr__(self, name, value):
+        self._attrs.append((name, value))
+        self.__dict__[name] = value
+
+class SheetBuffer(object):
+    """Worksheet-like object that records cells instead of writing them.
+    Supports the part of xlwt Worksheet interface used by Report.render.
+
+    """
+    def __init__(self, name=''):
+        self.name = name
+        self.last_used_row = 0
+        self._ops = []
+        self._rows = {}
+        self._cols = {}
+
+    def write(self, r, c, label='', style=None):
+        self.last_used_row = max(self.last_used_row, r)
+        self._ops.append((r, c, r, c, label, style))
+
+    def write_merge(self, r1, r2, c1, c2, label='', style=None):
+        self.last_used_row = max(self.last_used_row, r2)
+        self._ops.append((r1, c1, r2, c2, label, style))
+
+    def row(self, indx):
+        self.last_used_row = max(self.last_used_row, indx)
+        if indx not in self._rows:
+            self._rows[indx] = _Props()
+        return self._rows[indx]
+
+    def col(self, indx):
+        if indx not in self._cols:
+            self._cols[indx] = _Props()
+        return self._cols[indx]
+
+    def replay(self, ws, styles=None):
+        """Writes recorded cells to xlwt worksheet.
+
+        Keyword arguments:
+        ws --       xlwt worksheet
+        styles --   style table (dict). Equal styles are replaced with
+                    the first style of the table with the same key.
+
+        """
+        if styles is None:
+            styles = {}
+        resolved = {}
+        for r1, c1, r2, c2, label, style in self._ops:
+            if style is not None:
+                if id(style) not in resolved:
+                    resolved[id(style)] = styles.setdefault(style_key(style), style)
+                style = resolved[id(style)]
+            if r1 == r2 and c1 == c2:
+                ws.write(r1, c1, label, style)
+            else:
+                ws.write_merge(r1, r2, c1, c2, label, style)
+        for indx, props in sorted(self._rows.items()):
+            for name, value in props._attrs:
+                setattr(ws.row(indx), name, value)
+        for indx, props in sorted(self._cols.items()):
+            for name, value in props._attrs:
+                setattr(ws.col(indx), name, value)
+
+class Composer(object):
+    def __init__(self, workers=None):
+        """Creates a workbook composer.
+
+        Keyword arguments:
+        workers --      number of processes used to build sheets.
+                        By default sheets are built in the current process.
+
+        """
+        self.workers = workers
+        self.styles = {}        # Style table shared by all built workbooks
+        self._placements = []
+
+    def add(self, report, data, sheet, top=None, left=None, transpose=False):
+        """Adds report to the workbook.
+
+        Keyword arguments:
+        report --       Report object
+        data --         report data (see Report.render)
+        sheet --        name of the worksheet. Reports placed on the same
+                        sheet are drawn in the order they were added.
+        top, left --    report position on the sheet. By default the report
+                        is drawn below the previous one.
+        transpose --    transpose matrix
+
+        """
+        self._placements.append((report, data, sheet, top, left, transpose))
+
+    def sheets(self):
+        """Returns names of the sheets in the order they appear"""
+        names = []
+        for placement in self._placements:
+            if placement[2] not in names:
+                names.append(placement[2])
+        return names
+
+    def build(self, book=None):
+        """Builds all sheets and writes them into the workbook.
+        Returns the workbook.
+
+        Keyword arguments:
+        book --     xlwt Workbook. If not specified a new one is created.
+
+        """
+        global _placements
+        if book is None:
+            book = Workbook()
+        names = self.sheets()
+        _placements = self._placements
+        try:
+            if self.workers > 1 and len(names) > 1 and sys.platform != 'win32':
+                pool = Pool(min(self.workers, len(names)))
+                try:
+                    buffers = pool.map(_build_sheet, names, 1)
+                    pool.close()
+                finally:
+                    pool.terminate()
+                    pool.join()
+            else:
+                buffers = map(_build_sheet, names)
+        finally:
+            _placements = None
+        for buf in buffers:
+            buf.replay(book.add_sheet(buf.name), self.styles)
+        return book
+
+    def save(self, filename_or_stream, book=None):
+        """Builds the workbook and saves it"""
+        book = self.build(book)
+        book.save(filename_or_stream)
+        return book
+
+_placements = None  # Placements being built. Inherited by forked workers.
+
+def _build_sheet(name):
+    """Renders all reports placed on the sheet into a buffer"""
+    buf = SheetBuffer(name)
+    for report, data, sheet, top, left, transpose in _placements:
+        if sheet == name:
+            report.render(buf, data, transpose, top, left)
+    return buf
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+import sys
+import cPickle
+from types import FunctionType
+from cStringIO import StringIO
+from reports import Report, ReportException
+
+"""
+Serialized report layouts.
+
+Building a big section tree takes time. A layout can be built once,
+saved with dump() and loaded with load() by every worker or request:
+
+    # build.py
+    layout.dump(report, open('calendar.layout', 'wb'), funcs={'avg': avg})
+
+    # worker.py
+    def init():
+        global report
+        report = layout.load(open('calendar.layout', 'rb'), funcs={'avg': avg})
+    pool = Pool(initializer=init)
+
+The layout contains sections, fields, calc field selectors, styles,
+conditional style rules, calc functions and section data providers.
+The built objects are pickled as they are, so loading doesn't rebuild
+the section tree through its constructors: instances are restored
+directly (see benchmarks/layout.py).
+
+Functions are saved by reference, so they should be importable (e.g. sum
+or module-level functions). Other functions (e.g. lambdas) should be
+passed by name in the funcs mapping both to dump() and load().
+
+Layouts are pickled, so load only layouts you trust.
+
+"""
+
+MAGIC = 'xlrep-layout'
+VERSION = 6
+
+# Report attributes saved in a layout. Caches, trace and render state aren't.
+_ATTRS = ('caption', 'desc', 'cols_width', 'rows_height', 'row_header_style',
+          'col_header_style', 'cell_style', 'cell_filter', 'merge_styles',
+          'ignore_none', 'workers', 'memory_limit', 'rules', 'rows', 'cols')
+
+_DEPTH = 20000      # Recursion limit while a deep section tree is pickled
+
+def dumps(report, funcs=None):
+    """Returns serialized report layout.
+
+    Keyword arguments:
+    report --   Report object
+    funcs --    dict of functions that can't be saved by reference
+                (e.g. lambdas). Keys are names used by load().
+
+    """
+    names = dict((id(func), name) for name, func in (funcs or {}).items())
+
+    def persistent_id(obj):
+        if type(obj) is not FunctionType:
+            return None
+        if id(obj) in names:
+            return names[id(obj)]
+        if getattr(sys.modules.get(obj.__module__), obj.__name__, None) is not obj:
+            raise ReportException('Function %s can not be saved. Pass it in funcs.' % obj)
+        return None
+
+    stream = StringIO()
+    pickler = cPickle.Pickler(stream, cPickle.HIGHEST_PROTOCOL)
+    pickler.persistent_id = persistent_id
+    limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(max(limit, _DEPTH))
+    try:
+        pickler.dump(dict((name, getattr(report, name)) for name in _ATTRS))
+    except (cPickle.PicklingError, TypeError), e:
+        raise ReportException('Layout can not be saved: %s' % e)
+    finally:
+        sys.setrecursionlimit(limit)
+    return cPickle.dumps((MAGIC, VERSION, stream.getvalue()), cPickle.HIGHEST_PROTOCOL)
+
+def dump(report, fileobj, funcs=None):
+    """Writes serialized report layout to the file"""
+    fileobj.write(dumps(report, funcs))
+
+def loads(s, funcs=None):
+    """Creates report from serialized layout.
+
+    Keyword arguments:
+    s --        serialized layout
+    funcs --    dict of functions passed to dumps()
+
+    """
+    try:
+        magic, version, payload = cPickle.loads(s)
+    except Exception, e:
+        raise ReportException('Invalid layout: %s' % e)
+    if magic != MAGIC:
+        raise ReportException('Invalid layout')
+    if version != VERSION:
+        raise ReportException('Unsupported layout version %s. Expected %s.' % (version, VERSION))
+
+    funcs = funcs or {}
+
+    def persistent_load(name):
+        try:
+            return funcs[name]
+        except KeyError:
+            raise ReportException('Function %s is not passed in funcs' % name)
+
+    unpickler = cPickle.Unpickler(StringIO(payload))
+    unpickler.persistent_load = persistent_load
+    try:
+        attrs = unpickler.load()
+    except ReportException:
+        raise
+    except Exception, e:
+        raise ReportException('Invalid layout: %s' % e)
+    report = Report()
+    for name in _ATTRS:
+        setattr(report, name, attrs[name])
+    return report
+
+def load(fileobj, funcs=None):
+    """Creates report from serialized layout stored in the file"""
+    return loads(fileobj.read(), funcs)
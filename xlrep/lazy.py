@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+import sys
+from types import ModuleType
+
+"""
+Lazy module attributes.
+
+Used to avoid importing xlwt and building styles when the package is
+imported. Attributes are created on first access.
+
+"""
+
+class LazyModule(ModuleType):
+    """Module which attributes are created on first access"""
+    def __init__(self, module, loaders):
+        """Replaces module in sys.modules.
+
+        Keyword arguments:
+        module --   module to replace
+        loaders --  dict: attribute name -> function that creates its value
+
+        """
+        ModuleType.__init__(self, module.__name__, module.__doc__)
+        self.__dict__.update(module.__dict__)
+        # Keep the original module alive, otherwise its globals are cleared
+        self.__dict__['_module'] = module
+        self.__dict__['_loaders'] = loaders
+        sys.modules[module.__name__] = self
+
+    def __getattr__(self, name):
+        if name not in self._loaders:
+            raise AttributeError("'module' object has no attribute '%s'" % name)
+        value = self._loaders[name]()
+        setattr(self, name, value)
+        return value
+
+    def __dir__(self):
+        return sorted(set(self.__dict__) | set(self._loaders))
+
+def attribute(module, name):
+    """Returns loader that imports module and gets its attribute"""
+    def load():
+        __import__(module)
+        return getattr(sys.modules[module], name)
+    return load
+
+def submodule(module):
+    """Returns loader that imports module"""
+    def load():
+        __import__(module)
+        return sys.modules[module]
+    return load
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+import sys
+from multiprocessing import Pool
+from trace import _Samples
+
+"""
+Parallel evaluation of calc fields.
+
+Calc cells are split into dependency levels. Calcs of the same level don't
+depend on each other and are evaluated on a pool of worker processes.
+Workers are forked after the data matrix is built, so they share the data
+block with the parent process (copy-on-write) and only calc numbers and
+results are sent between processes. Calcs of the next levels get values of
+the cells they depend on with the task.
+
+"""
+
+_calcs = None   # Calcs being evaluated. Inherited by forked workers.
+_missing = object()
+
+def evaluate(data, workers):
+    """Evaluates callable cells of the data matrix in place.
+
+    Keyword arguments:
+    data --         data matrix (list of rows)
+    workers --      number of worker processes. If it is less than 2 or
+                    processes can't be forked calcs are evaluated serially.
+
+    """
+    global _calcs
+    cells = [(i, j) for i, row in enumerate(data) for j, item in enumerate(row) if callable(item)]
+    if not cells:
+        return
+    if workers < 2 or sys.platform == 'win32':
+        for i, j in cells:
+            data[i][j] = data[i][j]()
+        return
+
+    _calcs = [data[i][j] for i, j in cells]
+    levels = _levels(data, cells)
+    pool = Pool(workers)
+    try:
+        for level, group in enumerate(levels):
+            tasks = []
+            for k in group:
+                calc = _calcs[k]
+                if calc.key is not None:
+                    value = calc.cache.get(calc.key, _missing)
+                    if value is not _missing:
+                        i, j = cells[k]
+                        data[i][j] = value
+                        continue
+                if level == 0:
+                    tasks.append((k, None))
+                else:
+                    tasks.append((k, [data[i][j] for i, j in calc.index]))
+            chunksize = max(1, len(tasks) // (workers * 4))
+            for k, value, samples in pool.imap_unordered(_evaluate, tasks, chunksize):
+                calc = _calcs[k]
+                for sample in samples or ():
+                    calc.trace.record(calc.field, *sample)
+                if calc.key is not None:
+                    calc.cache.put(calc.key, value)
+                i, j = cells[k]
+                data[i][j] = value
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+        _calcs = None
+
+def _levels(data, cells):
+    """Splits calc cells into groups of independent calcs.
+    Returns list of groups, each group is a list of calc numbers."""
+    numbers = dict((cell, k) for k, cell in enumerate(cells))
+    levels = {}
+    for k, cell in enumerate(cells):
+        # Walk dependencies without recursion
+        stack = [k]
+        while stack:
+            n = stack[-1]
+            if n in levels:
+                stack.pop()
+                continue
+            deps = [numbers[c] for c in _calcs[n].index if c in numbers]
+            pending = [d for d in deps if d not in levels]
+            if pending:
+                stack.extend(pending)
+                continue
+            levels[n] = max([levels[d] + 1 for d in deps] or [0])
+            stack.pop()
+    groups = [[] for i in range(max(levels.values()) + 1)]
+    for k in range(len(cells)):
+        groups[levels[k]].append(k)
+    return groups
+
+def _evaluate(task):
+    """Worker routine. Traced calls are sent back with the value."""
+    k, values = task
+    calc = _calcs[k]
+    samples = None
+    if calc.trace is not None:
+        calc.trace = samples = _Samples()
+    if values is None:
+        return k, calc(), samples
+    return k, calc.apply(values), samples
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+
+"""
+Render plans.
+
+Report.plan estimates the cost of rendering a report from its section
+tree and the shape of the data, before any data is read:
+
+    plan = report.plan(rows=len(data), cols=len(data[0]))
+    if not plan.fits:
+        reject(plan.problems)
+    print plan
+
+Report.render makes the same plan, renders the report in the chosen
+mode and returns the plan.
+
+Modes:
+    memory --   the whole report matrix is built in memory
+    stream --   rows are computed and drawn one by one
+    spill --    like stream, but data rows are counted first in a
+                temporary file (reports without row fields)
+
+"""
+
+XLS_ROWS = 65536
+XLS_COLS = 256
+XLS_STYLES = 0xFFF - 0x11       # xlwt reserves 16 built-in XFs and the default style
+
+MODES = ('memory', 'stream', 'spill')
+
+class Plan(object):
+    """Estimated cost of rendering a report and the chosen render mode.
+    Counts that depend on unknown data size are None.
+
+    """
+    def __init__(self, mode, rows, cols, calc_cells, depth, styles, memory, limit=None):
+        """
+        Keyword arguments:
+        mode --         chosen render mode (see MODES)
+        rows, cols --   size of the report matrix (without headers)
+        calc_cells --   number of calc and series cells
+        depth --        longest chain of calc and series cells that
+                        depend on each other
+        styles --       upper bound of distinct cell styles
+        memory --       dict {mode: estimated peak memory in bytes} of
+                        the modes available for the report
+        limit --        memory budget of the report
+
+        """
+        self.mode = mode
+        self.rows = rows
+        self.cols = cols
+        self.calc_cells = calc_cells
+        self.depth = depth
+        self.styles = styles
+        self.memory = memory
+        self.limit = limit
+        self.problems = []
+        if rows is not None and rows > XLS_ROWS:
+            self.problems.append('%s rows exceed xls limit of %s rows' % (rows, XLS_ROWS))
+        if cols is not None and cols > XLS_COLS:
+            self.problems.append('%s columns exceed xls limit of %s columns' % (cols, XLS_COLS))
+        if styles is not None and styles > XLS_STYLES:
+            self.problems.append('Up to %s cell styles may exceed xls limit of %s styles' % (styles, XLS_STYLES))
+        if self.peak is not None and limit is not None and self.peak > limit:
+            self.problems.append('Estimated memory %s bytes exceeds memory limit of %s bytes' % (self.peak, limit))
+
+    @property
+    def cells(self):
+        """Number of report cells"""
+        if self.rows is None or self.cols is None:
+            return None
+        return self.rows * self.cols
+
+    @property
+    def peak(self):
+        """Estimated peak memory of the chosen mode"""
+        return self.memory.get(self.mode)
+
+    @property
+    def fits(self):
+        """True if the report can be rendered within xls limits
+        and the memory budget"""
+        return not self.problems
+
+    def as_dict(self):
+        """Returns the plan as a dict (e.g. to be dumped to JSON)"""
+        return {
+            'mode': self.mode,
+            'rows': self.rows,
+            'cols': self.cols,
+            'cells': self.cells,
+            'calc_cells': self.calc_cells,
+            'depth': self.depth,
+            'styles': self.styles,
+            'memory': dict(self.memory),
+            'peak': self.peak,
+            'limit': self.limit,
+            'problems': list(self.problems),
+        }
+
+    def __str__(self):
+        def show(value):
+            return '?' if value is None else str(value)
+        lines = [
+            'mode:        %s' % self.mode,
+            'cells:       %s x %s = %s' % (show(self.rows), show(self.cols), show(self.cells)),
+            'calc cells:  %s' % show(self.calc_cells),
+            'depth:       %s' % self.depth,
+            'styles:      %s' % show(self.styles),
+        ]
+        for mode in MODES:
+            if mode in self.memory:
+                lines.append('memory:      %s bytes (%s)' % (show(self.memory[mode]), mode))
+        lines.extend('problem:     %s' % problem for problem in self.problems)
+        return '\n'.join(lines)
+
+    def __repr__(self):
+        return '<Plan %s: %s cells, %s bytes>' % (self.mode, self.cells, self.peak)
+
+def choose(memory, limit):
+    """Returns the cheapest available mode: in memory if it fits
+    the limit (or the size is unknown and nothing else is available),
+    otherwise the mode that takes less memory.
+
+    Keyword arguments:
+    memory --   dict {mode: estimated peak memory or None if unknown}
+    limit --    memory budget or None
+
+    """
+    if limit is None or len(memory) == 1:
+        return 'memory'
+    if memory['memory'] is not None and memory['memory'] <= limit:
+        return 'memory'
+    return [mode for mode in MODES if mode in memory and mode != 'memory'][0]
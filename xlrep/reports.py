@@ -1,7 +1,18 @@
 # -*- coding: utf-8 -*-
-from xlwt import easyxf, XFStyle, Font
+import sys
+import cPickle
+from collections import OrderedDict, deque
+from itertools import chain, izip
+from tempfile import TemporaryFile
+from Queue import Queue, Full
+from threading import Thread, Event
+from timeit import default_timer
+from xlwt import XFStyle, Font
 from StringIO import StringIO
-from styles import caption_style, description_style, col_header_style, row_header_style, cell_style
+from aggregates import Aggregator, Sum, Count, Min, Max
+from rules import Rule, StyleTable
+from plan import Plan, choose
+import styles
 
 """
 Konstantin Selivanov, 2010
@@ -16,6 +27,12 @@ class ReportException(Exception):
     """Raise on internal errors"""
     pass
 
+_epoch = 0      # Changes with any section tree. Header layouts are cached by it.
+
+def _touch():
+    global _epoch
+    _epoch += 1
+
 class _truth_container(object):
     """Special collection that always returns True
     on the __contains__ check""" 
@@ -24,6 +41,11 @@ class _truth_container(object):
 
 class Field(object):
     """Abstract field class"""
+    # Defaults of field attributes. Pickled fields (see layout module)
+    # keep only the attributes that differ from them.
+    style = header_style = width = height = num_format = None
+    _level = 0
+
     def __init__(self, name, style=None, header_style=None, width=None, height=None, num_format=None):
         """Base field calls. Should not be created directly.
 
@@ -44,6 +66,13 @@ class Field(object):
         self.num_format = num_format
         self._level = 0
 
+    def __getstate__(self):
+        """Returns attributes that differ from the defaults.
+        Field index is set on every render, so it isn't kept."""
+        cls = type(self)
+        return dict((name, value) for name, value in self.__dict__.iteritems()
+                    if name != 'index' and getattr(cls, name, cls) is not value)
+
 class DataField(Field):
     """Field that contains data value"""
     def __init__(self, name, style=None, header_style=None, width=None, height=None, num_format=None):
@@ -94,8 +123,22 @@ class CalcField(Field):
         """Just return fields_ignore"""
         return self._cross_fields_ignore
 
+class SeriesField(Field):
+    def __init__(self, section, name, source, kind='sum', window=None, style=None, header_style=None, width=None, height=None, num_format=None):
+        """
+        Field that contains running values of the source field along
+        the opposite layout. Should not be created directly but only
+        through Section.add_series method.
+
+        """
+        Field.__init__(self, name, style, header_style, width, height, num_format)
+        self.sec = section
+        self.source = source
+        self.kind = kind
+        self.window = window
+
 class Section(object):
-    def __init__(self, name='', style=None, header_style=None, collapse=False):
+    def __init__(self, name='', style=None, header_style=None, collapse=False, provider=None, expand=True):
         """Section is a logical fields container. It should be used
         - to group fields
         - when calc fields are used 
@@ -105,18 +148,27 @@ class Section(object):
         style --            XFStyle that is applied to all cells in section
         header_style --     XFStyle that is only applied to header cells
         collapse --         if True creates section with ability to collapse
+        provider --         data provider of the row section (see add_section)
+        expand --           if False only calc and series fields of the
+                            section are drawn
 
         """
         self.name = name
         self.style = style
         self.header_style = header_style
         self.collapse = collapse
+        self.provider = provider
+        self.expand = expand
         self._items = []
         self.visible = False
         self._level = 0
         if self.name:
             self.visible = True         
 
+    def __setattr__(self, name, value):
+        _touch()
+        object.__setattr__(self, name, value)
+
     def add_field(self, name='', style=None, header_style=None, width=None, height=None, num_format=None):
         """Creates data field in the section.
         
@@ -134,15 +186,24 @@ class Section(object):
         field = DataField(name, style, header_style, width, height, num_format)
         field._level = self._level
         self._items.append(field)
+        _touch()
         return field
 
     def _add_fake_field(self):
-        """Create fake field"""
+        """Create fake field. Headers of a layout with fake fields are not
+        drawn, so cached header layouts stay valid (see _touch)."""
         field = DataField(name='', style=self.style, header_style=self.header_style)
+        field._fake = True
         self._items.insert(0, field)
         return field
 
-    def add_section(self, name='', style=None, header_style=None, collapse=True):
+    def _drop_fake_fields(self):
+        """Remove fake fields created while rendering.
+        Items are changed in place: the section tree is the same again."""
+        if any(getattr(item, '_fake', False) for item in self._items):
+            self._items[:] = [item for item in self._items if not getattr(item, '_fake', False)]
+
+    def add_section(self, name='', style=None, header_style=None, collapse=True, provider=None, expand=True):
         """Add subsection to the section.
         Section is a logical fields container. It should be used
         - to group fields
@@ -154,19 +215,39 @@ class Section(object):
         In the Report class there are two base sections
             report.cols - base column section 
             report.rows - base row section
-        
+
+        Row data of a section can be loaded lazily by a provider instead
+        of being passed to Report.render. The provider is called with the
+        list of the section data fields (fields of subsections with own
+        providers excluded) and returns their rows. It is called only if
+        the rows are drawn or needed by a calc field. If the provider has
+        aggregate(calc) method, it is asked for the values of the section
+        calc fields first: it returns calc values for the column data
+        fields or None if the calc should be computed from the rows.
+
+        Example: drill-down report that loads only region totals
+            region = report.rows.add_section('North', provider=north, expand=False)
+            ...
+            region.add_calc('Total', sum)
+
         Keyword arguments:
         name --             section name. If is set to empty string 
         style --            XFStyle that is applied to all cells in section
         header_style --     XFStyle that is only applied to header cells
         collapse --         if True creates section with ability to collapse
+        provider --         callable that gets data fields and returns their
+                            rows. Only row sections can have providers.
+        expand --           if False data fields and subsections of the
+                            section are not drawn, only its calc and
+                            series fields
 
         """
         style = style or self.style
         header_style = header_style or self.header_style
-        section = Section(name, style, header_style, collapse)
+        section = Section(name, style, header_style, collapse, provider, expand)
         section._level = self._level + (1 if collapse else 0)
         self._items.append(section)
+        _touch()
         return section
     
     def add_calc(self, name, func, fields=[], fields_ignore=[], cross_fields=[], cross_fields_ignore=[], style=None, header_style=None, width=None, height=None, num_format=None):
@@ -212,6 +293,57 @@ class Section(object):
         field = CalcField(self, name, func, fields, fields_ignore, cross_fields, cross_fields_ignore, style, header_style, width, height, num_format)
         field._level = self._level - (1 if self.collapse else 0)
         self._items.append(field)
+        _touch()
+        return field
+
+    def add_series(self, name, source, kind='sum', window=None, style=None, header_style=None, width=None, height=None, num_format=None):
+        """Add series field. Series field shows running values of the
+        source field along the opposite layout: e.g. a row series over
+        daily columns shows cumulative sums or moving averages of the
+        source row. The whole series is computed in one pass.
+
+        Example: daily trend
+            sales = report.rows.add_field('Sales')
+            report.rows.add_series('Cumulative', sales)
+            report.rows.add_series('7 day average', sales, 'mean', 7)
+            report.rows.add_series('Day over day', sales, 'delta')
+
+        Series cells are computed only for data fields of the opposite
+        layout. Calc fields are not computed over series cells. None
+        values are skipped by sums and means.
+
+        Keyword arguments:
+        name --             field name
+        source --           data, calc or series field of the same layout.
+                            It is checked when the report is rendered.
+        kind --             'sum' -- running sum (sum of last window
+                            values if window is set),
+                            'mean' -- running mean (moving average of
+                            last window values if window is set),
+                            'delta' -- difference with the value window
+                            (1 by default) positions before
+        window --           window size. If set the first window - 1
+                            cells are empty.
+        style --            XFStyle that is applied to all cells in section
+        header_style --     XFStyle that is only applied to header cells
+        width --            field width
+        height --           field height
+        num_format --       excel-like cell format
+
+        """
+        if kind not in _running.kinds:
+            raise ReportException('Unknown series kind: %s' % kind)
+        if window is not None and (not isinstance(window, (int, long)) or window < 1):
+            raise ReportException('Series window should be a positive integer: %s' % window)
+        if not isinstance(source, Field):
+            raise ReportException('Series source should be a field: %s' % source)
+        style = style or self.style
+        header_style = header_style or self.header_style
+
+        field = SeriesField(self, name, source, kind, window, style, header_style, width, height, num_format)
+        field._level = self._level
+        self._items.append(field)
+        _touch()
         return field
 
     def get_fields(self, field_cls=None):
@@ -222,17 +354,22 @@ class Section(object):
         field_cls -- object type to select 
         
         """
-        for item in self._items:
-            if issubclass(type(item), Field):
-                if not field_cls:
-                    yield item
-                elif type(item) == field_cls:
-                    yield item
-            elif type(item) == Section:
-                for subitem in item.get_fields(field_cls):
-                    yield subitem
+        # Iterative walk: nested generators would cost O(depth) per field
+        stack = [iter(self._items)]
+        while stack:
+            for item in stack[-1]:
+                if issubclass(type(item), Field):
+                    if not field_cls:
+                        yield item
+                    elif type(item) == field_cls:
+                        yield item
+                elif type(item) == Section:
+                    stack.append(iter(item._items))
+                    break
+                else:
+                    raise ReportException('Unknown item type: %s' % type(item))
             else:
-                raise ReportException('Unknown item type: %s' % type(item))
+                stack.pop()
 
     def get_data_fields(self):
         """Alias for get_fields(DataField)"""
@@ -242,12 +379,52 @@ class Section(object):
         """Alias for get_fields(CalcField)"""
         return self.get_fields(field_cls=CalcField)
 
+    def get_visible_fields(self):
+        """Generates fields that are drawn. Section that is not
+        expanded shows only its own calc and series fields."""
+        stack = [iter(_drawn_items(self))]
+        while stack:
+            for item in stack[-1]:
+                if type(item) == Section:
+                    stack.append(iter(_drawn_items(item)))
+                    break
+                yield item
+            else:
+                stack.pop()
+
+    def _providers(self):
+        """Returns OrderedDict {section with provider: its data fields}.
+        Fields of subsections belong to the nearest section with provider."""
+        found = OrderedDict()
+        stack = []
+
+        def enter(section, owner):
+            if section.provider is not None:
+                owner = section
+                found[section] = []
+            stack.append((iter(section._items), owner))
+
+        enter(self, None)
+        while stack:
+            items, owner = stack[-1]
+            for item in items:
+                if type(item) == Section:
+                    enter(item, owner)
+                    break
+                elif type(item) == DataField and owner is not None:
+                    found[owner].append(item)
+            else:
+                stack.pop()
+        return found
+
 class Report(object):
     OFFSET = 3
+    CELL_SIZE = 100         # Approximate memory cost of a report matrix cell in bytes
+    SPILL_BLOCK = 1000      # Rows in a block of spilled data
 
-    __slots__ = ['rows', 'cols', 'caption', 'desc', 'cols_width', 'rows_height', 'row_header_style', 'col_header_style', 'cell_style', 'cell_filter', 'merge_styles', 'ignore_none', '_top', '_left', '__fake_cols', '__fake_rows']
+    __slots__ = ['rows', 'cols', 'caption', 'desc', 'cols_width', 'rows_height', 'row_header_style', 'col_header_style', 'cell_style', 'cell_filter', 'merge_styles', 'ignore_none', 'calc_cache', 'workers', 'memory_limit', 'trace', 'rules', '_top', '_left', '_skipped', '_headers', '__fake_cols', '__fake_rows']
 
-    def __init__(self, caption='', desc='', cell_filter=None, merge_styles=True):
+    def __init__(self, caption='', desc='', cell_filter=None, merge_styles=True, calc_cache=None, workers=None, memory_limit=None, trace=None):
         """Creates a report.
         Report is created with two default sections:
         self.rows   -- row section
@@ -262,11 +439,25 @@ class Report(object):
                             cell values (e.g. to hides zero values)
                             It gets an singular value as input.
         merege_style --     Don't use it. It's not implemented yet.
+        calc_cache --       AggregateCache shared between reports that are
+                            rendered over the same data. Calc values over
+                            the same data cells are computed only once.
+        workers --          Number of processes used to evaluate calc
+                            fields. By default calcs are evaluated in the
+                            current process.
+        memory_limit --     Approximate memory budget in bytes of the report
+                            being rendered. Bigger reports are computed row
+                            by row without building the report matrix
+                            (see render and plan).
+        trace --            CalcTrace that records calls of calc field
+                            functions (see trace module)
 
         """
         self.rows = Section()
         self.cols = Section()
         self._top, self._left = 0, 0
+        self._skipped = set()
+        self._headers = {}
         self.caption = caption
         self.desc = desc
         self.cols_width = None
@@ -279,8 +470,52 @@ class Report(object):
         self.cell_filter = cell_filter
         self.merge_styles = merge_styles
         self.ignore_none = True
+        self.calc_cache = calc_cache
+        self.workers = workers
+        self.memory_limit = memory_limit
+        self.trace = trace
+        self.rules = []
+
+    def add_rule(self, style, test=None, above=None, below=None, rows=None, cols=None):
+        """Add conditional style. The style is merged with the style
+        of every data or calc cell that matches all the conditions.
+
+        Example: show negative numbers in red
+            report.add_rule(easyxf('font: colour red;'), below=0)
+
+        Keyword arguments:
+        style --    XFStyle applied to matching cells
+        test --     function that gets cell value and returns True
+                    if the style should be applied
+        above --    applies to numbers greater than this value
+        below --    applies to numbers less than this value
+        rows --     applies only to these row fields. Can be a list of
+                    fields and sections or a function that gets a field.
+        cols --     applies only to these column fields (see rows)
+
+        """
+        rule = Rule(style, test, above, below, rows, cols)
+        self.rules.append(rule)
+        return rule
 
-    def render(self, ws, data, transpose=False):
+    def add_band(self, style, size=1, axis='rows', rows=None, cols=None):
+        """Add banding: the style is applied to every other group
+        of rows (columns).
+
+        Keyword arguments:
+        style --    XFStyle applied to odd groups
+        size --     number of rows (columns) in a group
+        axis --     'rows' or 'cols'
+        rows, cols -- applies only to these fields (see add_rule)
+
+        """
+        if axis not in ('rows', 'cols'):
+            raise ReportException('Unknown axis: %s' % axis)
+        rule = Rule(style, rows=rows, cols=cols, band=size, axis=axis)
+        self.rules.append(rule)
+        return rule
+
+    def render(self, ws, data, transpose=False, top=None, left=None, preview=None):
         """Render the report. Constructs report and writes
         it to worksheet.
 
@@ -290,22 +525,219 @@ class Report(object):
                         List of rows is expected. If you have
                         list of columns insted just use transpose feature.
         transpose --    transpose matrix 
+        top, left --    report position. By default the report is drawn
+                        below the last used row of the worksheet.
+        preview --      number of data rows to draw. Other data rows are
+                        not drawn (nor loaded from section providers
+                        unless needed), but calc fields are computed
+                        over the whole data.
+
+        The render mode is chosen by plan(). If the report matrix
+        exceeds memory_limit of the report, the matrix is not built:
+        rows are computed and drawn one by one like in render_stream.
+        Aggregator calc functions (and sum, len, min and max) are
+        computed from partial results, other functions still collect
+        the values of their cells. Data of a report without row fields
+        is spilled to a temporary file while it is counted. Reports with
+        preview or lazy sections are always rendered in memory.
+
+        Returns the plan the report was rendered with.
 
         """
-        if ws.last_used_row:
-            self._top, self._left = ws.last_used_row + self.OFFSET, 0
+        rows, cols = _shape(data)
+        if transpose:
+            rows, cols = cols, rows
+        plan = self.plan(rows, cols, preview)
+        self.__place(ws, top, left)
         self.__draw_caption(ws)
         self.__draw_description(ws)
-        if transpose:
-            data = transposed(data)
-        self.__draw(ws, self.__render(data))
+        try:
+            if plan.mode != 'memory':
+                if transpose:
+                    data = izip(*data)
+                self.__draw(ws, self.__stream(self.__spill(data)))
+            else:
+                if transpose:
+                    data = transposed(data)
+                self.__draw(ws, enumerate(self.__render(data, preview)))
+        finally:
+            self.__cleanup()
+        return plan
+
+    def plan(self, rows=None, cols=None, preview=None, mode=None):
+        """Estimates the cost of rendering the report from its sections
+        and the data shape and chooses the render mode. Returns Plan
+        (see plan module). Nothing is rendered.
+
+        Example: admission control
+            plan = report.plan(len(data), len(data[0]))
+            if not plan.fits:
+                raise Rejected(plan.problems)
+
+        Keyword arguments:
+        rows --     number of data rows. Required only if the report
+                    has no row fields. None if unknown.
+        cols --     number of cells in a data row. Required only if the
+                    report has no column fields.
+        preview --  number of data rows to draw (see render)
+        mode --     render mode to plan for. By default the cheapest
+                    available mode is chosen.
+
+        """
+        rfields, cfields = list(self.rows.get_fields()), list(self.cols.get_fields())
+        (R, rdata), (C, cdata) = _extent(rfields, rows), _extent(cfields, cols)
+        cells = calc_cells = None
+        if R is not None and C is not None:
+            cells = R * C
+            calc_cells = cells - rdata * cdata
+
+        # Longest chain of dependent cells: calc cells depend on data
+        # cells (or on calc cells of the other layout), series on sources
+        depth = 0
+        for fields in (rfields, cfields):
+            levels = dict((field, int(type(field) == CalcField)) for field in fields)
+            for field in _ordered(f for f in fields if type(f) == SeriesField):
+                levels[field] = levels.get(field.source, 0) + 1
+            depth += max(levels.values() or [0])
+
+        # Every pair of row and column styles may give a distinct style,
+        # every matching rule may give one more
+        def keys(fields):
+            found = set((id(f.style) if f.style else None, f.num_format) for f in fields)
+            return len(found) or 1
+        styles = keys(rfields) * keys(cfields) << len(self.rules)
+        if cells is not None:
+            styles = min(styles, cells)
+
+        # Peak memory of available modes
+        cell = self.CELL_SIZE
+        memory = {'memory': cells * cell if cells is not None else None}
+        if preview is None and not self.rows._providers() \
+                and list(self.rows.get_visible_fields()) == rfields:
+            # Row calcs keep partial results for every column, other
+            # functions keep the values of their rows
+            fake = not any(type(row) == DataField for row in rfields)
+            kept = 1
+            for row in rfields:
+                if type(row) != CalcField:
+                    continue
+                if row.func in _incremental or isinstance(row.func, Aggregator):
+                    kept += 1
+                elif not fake:
+                    kept += len([f for f in row.sec.get_data_fields() if f in row.fields and f not in row.fields_ignore])
+                elif row.sec is not self.rows:
+                    continue            # fake rows are added to the root section
+                elif rows is None:
+                    kept = None
+                    break
+                else:
+                    kept += rows
+            rowwise = 'spill' if fake else 'stream'
+            memory[rowwise] = None
+            if kept is not None and C is not None:
+                memory[rowwise] = kept * C * cell
+                if rowwise == 'spill':
+                    memory[rowwise] += self.SPILL_BLOCK * C * cell
+        if mode is None:
+            mode = choose(memory, self.memory_limit)
+        elif mode not in memory:
+            raise ReportException('Render mode %s is not available for the report' % mode)
+        return Plan(mode, R, C, calc_cells, depth, styles, memory, self.memory_limit)
+
+    def render_stream(self, ws, rows, prefetch=100, top=None, left=None):
+        """Render the report while the data is being fetched.
+
+        Rows are read ahead in a background thread, so slow data sources
+        (DB cursors, paged APIs) are fetched while the report is drawn.
+        Each data row is drawn as soon as it arrives. Row calc fields are
+        accumulated and drawn when the data ends.
+
+        The report should have row fields, otherwise the whole data is
+        read first and rendered as usual. So are reports with row
+        sections that have providers or are not expanded.
+
+        Returns the plan the report is rendered with (see plan): the
+        'stream' mode, or the mode chosen by render if the data is read
+        first.
+
+        Keyword arguments:
+        ws --           xlwt worksheet where the report is drawn
+        rows --         iterable of data rows
+        prefetch --     max number of rows read ahead
+        top, left --    report position (see render)
+
+        """
+        if not list(self.rows.get_data_fields()) or self.rows._providers() \
+                or list(self.rows.get_visible_fields()) != list(self.rows.get_fields()):
+            return self.render(ws, list(rows), top=top, left=left)
+        source = fetched = prefetched(rows, prefetch)
+        try:
+            first = next(source, None)
+            self.__place(ws, top, left)
+            self.__draw_caption(ws)
+            self.__draw_description(ws)
+            cols = len(first) if first is not None else 0
+            plan = self.plan(None, cols, mode='stream')
+            self.__layout(0, cols)
+            if first is not None:
+                source = chain([first], source)
+            self.__draw(ws, self.__stream(source))
+        finally:
+            fetched.close()
+            self.__cleanup()
+        return plan
+
+    def __spill(self, data):
+        """Lays the report out for row by row rendering.
+        Returns iterator over data rows."""
+        rows = iter(data)
+        first = next(rows, None)
+        cols_count = len(first) if first is not None else 0
+        if first is not None:
+            rows = chain([first], rows)
+        if list(self.rows.get_data_fields()):
+            self.__layout(0, cols_count)
+            return rows
+        if not list(self.cols.get_data_fields()):
+            raise ReportException('At least one field should be added')
+
+        # Fake rows are created for every data row, so the data is
+        # counted first. Meanwhile it's kept in a temporary file.
+        spill, count, block = TemporaryFile(), 0, []
+        for row in rows:
+            block.append(row)
+            count += 1
+            if len(block) == self.SPILL_BLOCK:
+                cPickle.dump(block, spill, cPickle.HIGHEST_PROTOCOL)
+                block = []
+        if block:
+            cPickle.dump(block, spill, cPickle.HIGHEST_PROTOCOL)
+        self.__layout(count, cols_count)
+        return _unspilled(spill, count)
+
+    def __place(self, ws, top, left):
+        """Sets report position"""
+        if top is not None:
+            self._top, self._left = top, left or 0
+        elif ws.last_used_row:
+            self._top, self._left = ws.last_used_row + self.OFFSET, 0
+        else:
+            self._top, self._left = 0, left or 0
+
+    def __cleanup(self):
+        """Fake fields depend on data, so they are dropped after rendering
+        and the report can be rendered again"""
+        self.rows._drop_fake_fields()
+        self.cols._drop_fake_fields()
+        self.__fake_rows = self.__fake_cols = False
+        self._skipped = set()
             
     def __draw_caption(self, ws):
         """Draws a report caption"""
         if not self.caption:
             return
         for line in self.caption.splitlines():
-            ws.write(self._top, self._left, line, caption_style)
+            ws.write(self._top, self._left, line, styles.caption_style)
             self._top += 1
 
     def __draw_description(self, ws):
@@ -313,10 +745,10 @@ class Report(object):
         if not self.desc:
             return
         for line in self.desc.splitlines():
-            ws.write(self._top, self._left, line, description_style)
+            ws.write(self._top, self._left, line, styles.description_style)
             self._top += 1
 
-    def __render(self, data_matrix):
+    def __render(self, data_matrix, preview=None):
         """Main rendering routine"""
         data = list(data_matrix)
         _data = []
@@ -328,73 +760,272 @@ class Report(object):
         if not rfields and not cfields:
             raise ReportException('At least one field should be added')
 
+        # Rows of sections with providers are not in the input data
+        providers = self.rows._providers()
+        if self.cols._providers() or list(self.cols.get_visible_fields()) != list(self.cols.get_fields()):
+            raise ReportException('Only row sections can have providers or be not expanded')
+        provided = set(chain(*providers.values()))
+        rfields = [row for row in rfields if row not in provided]
+
         # Check dimensions compatibility
         # If rfields == 0 then it seem we should build fake fields
-        if len(data) != len(rfields) and len(rfields) !=0:
+        if len(data) != len(rfields) and (len(rfields) != 0 or provided):
             raise ReportException('Row fields count does not match input data rows count. Expected %s but got %s.' % (len(rfields), len(data)))
         for i, row in enumerate(data):
             # If cfields == 0 then it seem we should build fake fields
             if len(cfields) != len(row) and len(cfields) !=0:
                 raise ReportException("Cells count in %sth row do not match input data. Expected %s bot got %s." % (i+1, len(cfields), len(row)))
 
-        # Append fake rows if required
-        if not rfields:
-            for i in range(len(data)):
-                self.rows._add_fake_field()
-            self.__fake_rows = True
-
-        # Append fake columns if required
-        if not cfields:
-            for i in range(len(data[0])):
-                self.cols._add_fake_field()
-            self.__fake_cols = True
-
-        # Enumerate rows
-        for i, row in enumerate(self.rows.get_fields()):
-            row.index = i
-        for i, col in enumerate(self.cols.get_fields()):
-            col.index = i
+        self.__layout(len(data), len(data[0]) if data else 0)
+        rfields = [row for row in self.rows.get_data_fields() if row not in provided]
+        cfields = list(self.cols.get_data_fields())
+        rows = dict(zip(rfields, data))
+        visible = list(self.rows.get_visible_fields())
+        if preview is not None:
+            drawn = [row for row in visible if type(row) == DataField][:max(preview, 0)]
+            self._skipped = set(row for row in visible if type(row) == DataField).difference(drawn)
+        visible = set(visible).difference(self._skipped)
+        aggregated = self.__provide(providers, rows, cfields, visible)
 
         # Making result Matrix and fill it with initial data
-        key = lambda item: type(item) == DataField
-        for i, row in enumerate_if(self.rows.get_fields(), key):
-            _row = []
-            for j, col in enumerate_if(self.cols.get_fields(), key):
-                if type(col) == type(row) == DataField:
-                    _row.append(data[i][j])
-                else:
-                    _row.append(None)
+        cols = list(self.cols.get_fields())
+        width = len(cols)
+        for row in self.rows.get_fields():
+            _row = [None] * width
+            values = rows.get(row)
+            if values is not None:
+                for col, value in zip(cfields, values):
+                    _row[col.index] = value
             _data.append(_row)
 
-        # Set calc items for rows
+        # Calc cache keys. Data cell is keyed by its input data position,
+        # calc cell is keyed by keys of the cells it depends on.
+        cache, token, keys = self.calc_cache, None, {}
+        if cache is not None:
+            token = cache.dataset(data)
+        if token is not None:
+            rpos = dict((row.index, i) for i, row in enumerate(rfields))
+            cpos = dict((col.index, j) for j, col in enumerate(cfields))
+            for i in rpos:
+                for j in cpos:
+                    keys[i, j] = (rpos[i], cpos[j])
+
+        def calc_key(axis, func, index):
+            if token is None:
+                return None
+            cells = tuple(keys.get(cell) for cell in index)
+            if None in cells:
+                return None
+            return (token, axis, cells, func, self.ignore_none)
+
+        # Set calc items for rows. Calcs aggregated by providers are values.
         for row in self.rows.get_calc_fields():
-            for col in self.cols.get_fields():
+            if row not in visible:
+                continue
+            if row in aggregated:
+                for col, value in zip(cfields, aggregated[row]):
+                    if col in row.cross_fields and col not in row.cross_fields_ignore:
+                        _data[row.index][col.index] = value
+                continue
+            selected = [f.index for f in row.sec.get_data_fields() if f in row.fields and f not in row.fields_ignore]
+            for col in cols:
+                if type(col) == SeriesField:
+                    continue
                 if col in row.cross_fields and col not in row.cross_fields_ignore:
-                    index = []
-                    for f in row.sec.get_data_fields():
-                        if f in row.fields and f not in row.fields_ignore:
-                            index.append((f.index, col.index))
-                    _data[row.index][col.index] = _calc(row.func, index, _data, self.ignore_none)
+                    index = [(i, col.index) for i in selected]
+                    key = keys[row.index, col.index] = calc_key('rows', row.func, index)
+                    _data[row.index][col.index] = _calc(row.func, index, _data, self.ignore_none, cache, key, row, self.trace)
 
         # Set calc items for columns
         for col in self.cols.get_calc_fields():
+             selected = [f.index for f in col.sec.get_data_fields() if f in col.fields and f not in col.fields_ignore]
              for row in self.rows.get_fields():
+                if row not in visible and row not in rows or type(row) == SeriesField:
+                    continue        # not drawn and has no data
                 if row in col.cross_fields and row not in col.cross_fields_ignore:
-                    index = []
-                    for f in col.sec.get_data_fields():
-                        if f in col.fields and f not in col.fields_ignore:
-                            index.append((row.index, f.index))
-                    _data[row.index][col.index] = _calc(col.func, index, _data, self.ignore_none)
+                    index = [(row.index, j) for j in selected]
+                    key = keys[row.index, col.index] = calc_key('cols', col.func, index)
+                    _data[row.index][col.index] = _calc(col.func, index, _data, self.ignore_none, cache, key, col, self.trace)
 
         # Second pass: evaluate callable item
-        for i, row in enumerate(_data):
-            for j, item in enumerate(row):
-                if callable(item):
-                    _data[i][j] = item()
+        if self.workers and not self._skipped:
+            from parallel import evaluate       # multiprocessing is imported only when used
+            evaluate(_data, self.workers)
+        else:
+            skipped = set(row.index for row in self._skipped)
+            for i, row in enumerate(_data):
+                if i in skipped:
+                    continue        # preview: evaluated only if other cells need it
+                for j, item in enumerate(row):
+                    if callable(item):
+                        _data[i][j] = item()
+
+        # Third pass: series over evaluated cells
+        self.__series(_data)
         return _data
 
+    def __series(self, _data):
+        """Computes series fields. Every series is a single pass
+        over the cells of its source."""
+        def cell(i, j):
+            item = _data[i][j]
+            return item() if callable(item) else item
+
+        rpos = [row.index for row in self.rows.get_data_fields()]
+        cpos = [col.index for col in self.cols.get_data_fields()]
+        for field in _ordered(self.rows.get_fields(SeriesField)):
+            values = _running.series(field, [cell(field.source.index, j) for j in cpos])
+            for j, value in zip(cpos, values):
+                _data[field.index][j] = value
+        for field in _ordered(self.cols.get_fields(SeriesField)):
+            values = _running.series(field, [cell(i, field.source.index) for i in rpos])
+            for i, value in zip(rpos, values):
+                _data[i][field.index] = value
+
+    def __provide(self, providers, rows, cfields, visible):
+        """Loads rows of sections with providers that are drawn or needed
+        by drawn calc fields. Returns {calc field: values} for calcs
+        aggregated by providers. Loaded rows are added to rows dict."""
+        needed = set(row for row in chain(*providers.values()) if row in visible)
+        loaded = set(section for section, fields in providers.items() if needed.intersection(fields))
+
+        # Calcs of not loaded sections are asked from providers first
+        needed.update(row.source for row in visible if type(row) == SeriesField)
+
+        aggregated = {}
+        for row in self.rows.get_calc_fields():
+            if row not in visible:
+                continue
+            if row.sec in providers and row.sec not in loaded and hasattr(row.sec.provider, 'aggregate'):
+                values = row.sec.provider.aggregate(row)
+                if values is not None:
+                    if len(values) != len(cfields):
+                        raise ReportException('Provider of section %s returned %s values of %s. Expected %s.' % (row.sec.name, len(values), row.name, len(cfields)))
+                    aggregated[row] = values
+                    continue
+            needed.update(f for f in row.sec.get_data_fields() if f in row.fields and f not in row.fields_ignore)
+
+        for section, fields in providers.items():
+            if not needed.intersection(fields):
+                continue
+            data = list(section.provider(fields))
+            if len(data) != len(fields):
+                raise ReportException('Provider of section %s returned %s rows. Expected %s.' % (section.name, len(data), len(fields)))
+            for row, values in zip(fields, data):
+                if len(values) != len(cfields):
+                    raise ReportException('Provider of section %s returned %s cells in row %s. Expected %s.' % (section.name, len(values), row.name, len(cfields)))
+                rows[row] = values
+        return aggregated
+
+    def __stream(self, source):
+        """Streaming rendering routine. Yields (row index, row cells)
+        for data rows as they arrive and then for row calc fields.
+        Row series follow their sources."""
+        rfields = list(self.rows.get_data_fields())
+        cols = list(self.cols.get_fields())
+        cfields = [col for col in cols if type(col) == DataField]
+
+        # Column calcs are computed for every row
+        col_calcs = []
+        for col in self.cols.get_calc_fields():
+            index = [f.index for f in col.sec.get_data_fields() if f in col.fields and f not in col.fields_ignore]
+            col_calcs.append((col, index, _calc(col.func, index, None, self.ignore_none, field=col, trace=self.trace)))
+
+        def fill(row, items):
+            for col, index, calc in col_calcs:
+                if row in col.cross_fields and row not in col.cross_fields_ignore:
+                    items[col.index] = calc.apply([items[j] for j in index])
+
+        # Row calcs accumulate values of the rows they depend on.
+        # Cells of column calcs over the row are left to the column calcs.
+        row_calcs, feeds = [], {}
+        for row in self.rows.get_calc_fields():
+            index = [col.index for col in cols if col in row.cross_fields and col not in row.cross_fields_ignore
+                     and type(col) != SeriesField and not (type(col) == CalcField and row in col.cross_fields
+                     and row not in col.cross_fields_ignore)]
+            acc = _accumulator(row.func, index, self.ignore_none, row, self.trace)
+            row_calcs.append((row, acc))
+            for f in row.sec.get_data_fields():
+                if f in row.fields and f not in row.fields_ignore:
+                    feeds.setdefault(f, []).append(acc)
+
+        # Column series run down the data rows, row series are
+        # computed when their source rows are ready
+        col_series = [(col, _running(col.kind, col.window)) for col in _ordered(self.cols.get_fields(SeriesField))]
+        row_series = {}
+        for row in self.rows.get_fields(SeriesField):
+            row_series.setdefault(row.source.index, []).append(row)
+        cpos = [col.index for col in cfields]
+
+        def emit(index, items):
+            yield index, items
+            for row in row_series.get(index, ()):
+                series = [None] * len(cols)
+                for j, value in zip(cpos, _running.series(row, [items[j] for j in cpos])):
+                    series[j] = value
+                for pair in emit(row.index, series):
+                    yield pair
+
+        count = 0
+        for i, data_row in enumerate(source):
+            if i >= len(rfields):
+                raise ReportException('Row fields count does not match input data rows count. Expected %s but got more.' % len(rfields))
+            if len(cfields) != len(data_row):
+                raise ReportException("Cells count in %sth row do not match input data. Expected %s bot got %s." % (i+1, len(cfields), len(data_row)))
+            row = rfields[i]
+            items = [None] * len(cols)
+            for col, value in zip(cfields, data_row):
+                items[col.index] = value
+            fill(row, items)
+            for col, running in col_series:
+                try:
+                    items[col.index] = running.add(items[col.source.index])
+                except Exception, e:
+                    raise ReportException('Data should be compatible with series %s: %s' % (col.name, e))
+            for acc in feeds.get(row, ()):
+                acc.add(items)
+            for pair in emit(row.index, items):
+                yield pair
+            count += 1
+        if count != len(rfields):
+            raise ReportException('Row fields count does not match input data rows count. Expected %s but got %s.' % (len(rfields), count))
+
+        for row, acc in row_calcs:
+            items = [None] * len(cols)
+            acc.result(items)
+            fill(row, items)
+            for pair in emit(row.index, items):
+                yield pair
+
+    def __layout(self, rows_count, cols_count):
+        """Appends fake fields if required and enumerates fields"""
+        # Append fake rows if required
+        if not list(self.rows.get_data_fields()):
+            for i in range(rows_count):
+                self.rows._add_fake_field()
+            self.__fake_rows = True
+
+        # Append fake columns if required
+        if not list(self.cols.get_data_fields()):
+            for i in range(cols_count):
+                self.cols._add_fake_field()
+            self.__fake_cols = True
+
+        # Enumerate rows
+        for i, row in enumerate(self.rows.get_fields()):
+            row.index = i
+        for i, col in enumerate(self.cols.get_fields()):
+            col.index = i
+
+        # Series run over fields of their own layout
+        for items in (self.rows, self.cols):
+            fields = set(items.get_fields())
+            for field in items.get_fields(SeriesField):
+                if field.source not in fields:
+                    raise ReportException('Source of series %s should be a field of the same layout' % field.name)
+
     def __draw(self, ws, data):
-        """Main drawing routine"""
+        """Main drawing routine. Data is a sequence of (row index, row cells)."""
         top, left = self._top, self._left
 
         # Get styles
@@ -412,7 +1043,7 @@ class Report(object):
 
         # Rendering rows
         if not self.__fake_rows:
-            size, left_offset, row_headers = self.__render_headers(self.rows, left, top)
+            size, left_offset, row_headers = self.__render_headers(self.rows, left, top, self._skipped)
         else:
             left_offset, row_headers = 0, []
 
@@ -429,7 +1060,10 @@ class Report(object):
         for item, r, c, r_size, c_size in col_headers:
             header_style = item.header_style or item.style \
                     or self.col_header_style
-            ws.write_merge(r, r + r_size - 1, left_offset + c, left_offset + c + c_size - 1, item.name, header_style)
+            if r_size == c_size == 1:
+                ws.write(r, left_offset + c, item.name, header_style)
+            else:
+                ws.write_merge(r, r + r_size - 1, left_offset + c, left_offset + c + c_size - 1, item.name, header_style)
             if isinstance(item, Field):
                 if item.height:
                     ws.row(r).height = item.height
@@ -441,14 +1075,30 @@ class Report(object):
         for item, c, r, c_size, r_size in row_headers:
             header_style = item.header_style or item.style \
                     or self.row_header_style
-            ws.write_merge(top_offset + r, top_offset + r + r_size - 1, c, c + c_size - 1, item.name, header_style)
+            if r_size == c_size == 1:
+                ws.write(top_offset + r, c, item.name, header_style)
+            else:
+                ws.write_merge(top_offset + r, top_offset + r + r_size - 1, c, c + c_size - 1, item.name, header_style)
             if isinstance(item, Field):
                 ws.row(top_offset + r).level = item._level
         left += left_offset
 
+        # Conditional styles and number formats are laid over copies
+        # of cell styles, shared styles are not changed
+        table = StyleTable(self.rules, list(self.rows.get_fields()), list(self.cols.get_fields()))
+
+        # Rows of not expanded sections are skipped
+        positions = {}
+        for row in self.rows.get_visible_fields():
+            if row not in self._skipped:
+                positions[row.index] = len(positions)
+
         # Drawing data
-        for i, items in enumerate(data):
+        for i, items in data:
+            if i not in positions:
+                continue
             row_style, row_num_format = row_styles[i]
+            matches = table.match(i, items, positions[i])
             for j, item in enumerate(items):
                 # Here should be styles merging
                 col_style, col_num_format = column_styles[j]
@@ -462,18 +1112,24 @@ class Report(object):
                 else:
                     cell_style = row_style or col_style or self.cell_style
 
-                # TODO: move following to styles merge block
-                if row_num_format:
-                    cell_style.num_format_str = row_num_format
-                elif col_num_format:
-                    cell_style.num_format_str = col_num_format
+                num_format = row_num_format or col_num_format
+                matched = matches[j] if matches else ()
+                if num_format or matched:
+                    cell_style = table.style(cell_style, num_format, matched)
 
-                ws.write(top + i, left + j, item, cell_style)
+                ws.write(top + positions[i], left + j, item, cell_style)
     
-    def __render_headers(self, items, top, left):
-        """Render folded headers"""
-        size, cells = _head_render(items)
-        level_count = max(i[1] for i in cells) + 1
+    def __render_headers(self, items, top, left, skip=()):
+        """Render folded headers. The layout is cached until
+        a section tree changes."""
+        skip = frozenset(skip)
+        cached = self._headers.get(items)
+        if cached is not None and cached[:2] == (_epoch, skip):
+            size, cells = cached[2:]
+        else:
+            size, cells = _head_render(items, skip=skip)
+            self._headers[items] = (_epoch, skip, size, cells)
+        level_count = max([i[1] for i in cells] or [-1]) + 1
 
         items = []
         for item, r, c, r_size, c_size in cells:
@@ -486,7 +1142,7 @@ class Report(object):
 
 styles_cache = {}   # Workout to avoid XFStyle limit
 
-def merge_styles(row_style, col_style, default_style=easyxf('')):
+def merge_styles(row_style, col_style, default_style=None):
     """Merges row and column style.
 
     Method tries to get "strongest" style feauters from col (row) style
@@ -495,6 +1151,8 @@ def merge_styles(row_style, col_style, default_style=easyxf('')):
     Alas, it doesn't stable yet.
         
     """
+    if default_style is None:
+        default_style = styles.default_style
 
     if (row_style, col_style) in styles_cache:
         new_style = styles_cache[row_style, col_style]
@@ -536,7 +1194,7 @@ def merge_styles(row_style, col_style, default_style=easyxf('')):
 def merge_fonts(row_font, col_font, default_font):
     fields = [
         'bold', 'charset', 'colour_index', 'escapement', 'family',
-        'get_biff_record', 'height', 'italic', 'name',
+        'height', 'italic', 'name',
         'outline', 'shadow', 'struck_out', 'underline',
     ]
 
@@ -548,40 +1206,72 @@ def merge_fonts(row_font, col_font, default_font):
             setattr(new_font, field, getattr(row_font, field))
     return new_font
     
-def _head_render(item, level=0, pos=0):
+def _head_render(section, skip=()):
     '''
-    Recursive function to render header cells according to sections
-    hierarchy. Section won't be drawn if its name is empty.
+    Function to render header cells according to sections hierarchy.
+    Section won't be drawn if its name is empty or nothing is drawn in it.
+    Sections are walked iteratively in one pass, so the time is linear
+    in the number of items whatever the depth.
     Return value: size, [cell(name, x,y,x_size, y_size), cell(...), ...]
+    Section cell precedes cells of its items.
     '''
-    if isinstance(item, Field):
-        return 1, [(item, level, pos, 0, 1)]
-    items = []
-    size = 0
-    # Skip section level if section name is not defined
-    if item.name:
-        level = level + 1
-    for child in item._items:
-        child_size, children = _head_render(child, level, pos + size)
-        items.extend(children)
-        size += child_size
-    # Do not add section if name is not defined
-    if not item.name:
-        return size, items
-    return size, [(item, level-1, pos, 1, size)] + items
+    cells = []
+    pos = 0
+    stack = []
+
+    def enter(section, level):
+        # Section cell is reserved and filled in when its size is known.
+        # Skip section level if section name is not defined.
+        slot = None
+        if section.name:
+            slot = len(cells)
+            cells.append(None)
+            level += 1
+        stack.append((section, iter(_drawn_items(section)), level, pos, slot))
+
+    enter(section, 0)
+    while stack:
+        section, items, level, start, slot = stack[-1]
+        for item in items:
+            if isinstance(item, Field):
+                if item not in skip:
+                    cells.append((item, level, pos, 0, 1))
+                    pos += 1
+            else:
+                enter(item, level)
+                break
+        else:
+            stack.pop()
+            if slot is not None and pos > start:
+                cells[slot] = (section, level - 1, start, 1, pos - start)
+    return pos, [cell for cell in cells if cell is not None]
+
+def _drawn_items(section):
+    """Returns items of the section that are drawn"""
+    if section.expand:
+        return section._items
+    return [item for item in section._items if type(item) in (CalcField, SeriesField)]
 
 class _calc(object):
     """Class that represents calculation.
     Do not use directly.
     
     """
-    def __init__(self, func, index, data, ignore_none=True):
+    def __init__(self, func, index, data, ignore_none=True, cache=None, key=None, field=None, trace=None):
         self.func = func
         self.index = index
         self.data = data
         self.ignore_none = ignore_none
+        self.cache = cache
+        self.key = key
+        self.field = field
+        self.trace = trace
     def __call__(self, visited=set()):
         # TODO: raise exception on cyclic references
+        if self.key is not None:
+            result = self.cache.get(self.key, _calc)
+            if result is not _calc:
+                return result
         _data = []
         for i, j in self.index:
             cell = self.data[i][j]
@@ -590,14 +1280,218 @@ class _calc(object):
             else:
                 v = cell
             _data.append(v)
+        return self.apply(_data)
+
+    def apply(self, _data):
+        """Applies aggregation function to the values of the cells"""
+        size = len(_data)
         try:
             if self.ignore_none:     # Filter items with None value
                 _data = filter(lambda item: item != None, _data)
+            start = default_timer() if self.trace is not None else 0
             result = self.func(_data)
         except Exception, e:
-            raise ReportException('Data should be compatible with aggregation function:  %s, %s: %s' % (str(_data), str(self.func), str(e)))
+            # Original traceback is kept, so it points to the function
+            raise _calc_error(self.field, _data, self.func, e), None, sys.exc_info()[2]
+        if self.trace is not None:
+            self.trace.record(self.field, default_timer() - start, len(_data), size - len(_data))
+        if self.key is not None:
+            self.cache.put(self.key, result)
         return result
 
+def _calc_error(field, data, func, e):
+    """Returns ReportException for the error of calc field function"""
+    if field is None:
+        return ReportException('Data should be compatible with aggregation function:  %s, %s: %s' % (str(data), str(func), str(e)))
+    return ReportException('Data should be compatible with aggregation function of calc field %s (section %s):  %s, %s: %s'
+            % (field.name, field.sec.name, str(data), str(func), str(e)))
+
+_incremental = {sum: Sum(), len: Count(), min: Min(), max: Max()}
+
+class _accumulator(object):
+    """Accumulates cells of a calc field row by row.
+    Aggregator functions (and builtins that have aggregator
+    equivalents) are fed value by value, other functions get
+    the list of values at the end.
+
+    """
+    def __init__(self, func, index, ignore_none=True, field=None, trace=None):
+        self.calc = _calc(func, None, None, ignore_none, field=field, trace=trace)
+        self.field = field
+        self.trace = trace
+        self.builtin = func in _incremental
+        func = _incremental.get(func, func)
+        self.func = func
+        self.ignore_none = ignore_none
+        self.incremental = isinstance(func, Aggregator)
+        if self.incremental:
+            self.values = dict((j, func.start()) for j in index)
+        else:
+            self.values = dict((j, []) for j in index)
+
+    def add(self, items):
+        """Adds cells of the row"""
+        values = self.values
+        if not self.incremental:
+            for j in values:
+                values[j].append(items[j])
+            return
+        add = self.func.add
+        start, filtered = default_timer() if self.trace is not None else 0, 0
+        try:
+            for j in values:
+                if items[j] is not None or not self.ignore_none:
+                    values[j] = add(values[j], items[j])
+                else:
+                    filtered += 1
+        except Exception, e:
+            raise _calc_error(self.field, items[j], self.func, e), None, sys.exc_info()[2]
+        if self.trace is not None:
+            self.trace.record(self.field, default_timer() - start, len(values) - filtered, filtered)
+
+    def result(self, items):
+        """Puts aggregated values to the row cells"""
+        for j, value in self.values.items():
+            if self.builtin and value is None:
+                items[j] = self.calc.apply([])      # min and max of nothing fail as usual
+            elif self.incremental:
+                items[j] = self.func.result(value)
+            else:
+                items[j] = self.calc.apply(value)
+
+def _shape(data):
+    """Returns (rows, cells in a row) of the data or (None, None)
+    if the data is not a sequence"""
+    try:
+        return len(data), len(data[0]) if len(data) else 0
+    except TypeError:
+        return None, None
+
+def _extent(fields, count):
+    """Returns (number of fields, number of data fields) of a layout.
+    Fake fields are counted if the layout has no data fields."""
+    data = len([f for f in fields if type(f) == DataField])
+    if data:
+        return len(fields), data
+    if count is None:
+        return None, None
+    return len(fields) + count, count
+
+def _unspilled(spill, count):
+    """Reads rows back from the spill file and closes it"""
+    try:
+        spill.seek(0)
+        while count > 0:
+            block = cPickle.load(spill)
+            count -= len(block)
+            for row in block:
+                yield row
+    finally:
+        spill.close()
+
+class _running(object):
+    """Running state of a series. Each value is added in O(1)."""
+    kinds = ('sum', 'mean', 'delta')
+
+    def __init__(self, kind, window=None):
+        self.kind = kind
+        self.window = window or (1 if kind == 'delta' else None)
+        self.last = deque()
+        self.total = 0
+        self.count = 0          # not None values in the window
+
+    def add(self, value):
+        """Adds next value. Returns series value at this position."""
+        last, window = self.last, self.window
+        if self.kind == 'delta':
+            result = None
+            if len(last) == window:
+                prev = last.popleft()
+                if value is not None and prev is not None:
+                    result = value - prev
+            last.append(value)
+            return result
+        if value is not None:
+            self.total += value
+            self.count += 1
+        if window is not None:
+            last.append(value)
+            if len(last) > window:
+                prev = last.popleft()
+                if prev is not None:
+                    self.total -= prev
+                    self.count -= 1
+            if len(last) < window:
+                return None
+        if not self.count:
+            return None
+        if self.kind == 'mean':
+            return 1.0 * self.total / self.count
+        return self.total
+
+    @staticmethod
+    def series(field, values):
+        """Returns series of the field over the source values"""
+        running = _running(field.kind, field.window)
+        try:
+            return [running.add(value) for value in values]
+        except Exception, e:
+            raise ReportException('Data should be compatible with series %s: %s' % (field.name, e))
+
+def _ordered(fields):
+    """Orders series fields so that series of series follow their sources"""
+    fields = list(fields)
+    pending, done, result = set(fields), set(), []
+    for field in fields:
+        path = []
+        while field in pending and field not in done:
+            path.append(field)
+            done.add(field)
+            field = field.source
+        result.extend(reversed(path))
+    return result
+
+def prefetched(iterable, size=100):
+    """Iterates over iterable reading up to size items ahead
+    in a background thread. Exceptions of the iterable are caught
+    in the reading thread and raised again in the consuming one,
+    with the original traceback.
+
+    """
+    queue, stop, end = Queue(size), Event(), object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((None, item)):
+                    return
+            put((None, end))
+        except Exception:
+            put((sys.exc_info(), None))
+
+    thread = Thread(target=produce)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            error, item = queue.get()
+            if error:
+                raise error[0], error[1], error[2]
+            if item is end:
+                return
+            yield item
+    finally:
+        stop.set()
+
 def enumerate_if(seq, key=lambda: True):
     """Enumerates sequence. If condition doesn't hold
     yields the same number.
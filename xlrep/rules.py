@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+from copy import deepcopy
+from xlwt import XFStyle
+
+"""
+Conditional cell styles.
+
+Rules are added to a report with Report.add_rule and Report.add_band
+and are evaluated when the report is drawn. Parts of a matching rule
+style that differ from the default style (font colour, pattern, number
+format, ...) are laid over the regular cell style, other parts of the
+cell style are kept.
+Merged styles are kept in one table, so the number of XF records is
+bounded by the number of distinct (cell style, matching rules) pairs.
+
+"""
+
+_numbers = (int, long, float)
+_parts = ('font', 'alignment', 'borders', 'pattern', 'protection')
+_default = XFStyle()
+
+class Rule(object):
+    def __init__(self, style, test=None, above=None, below=None, rows=None, cols=None, band=None, axis='rows'):
+        """Conditional cell style. Should not be created directly
+        but only through Report.add_rule and Report.add_band methods.
+
+        """
+        self.style = style
+        self.test = test
+        self.above = above
+        self.below = below
+        self.rows = rows
+        self.cols = cols
+        self.band = band
+        self.axis = axis
+
+    def _matches(self, value):
+        """Returns True if the rule matches the value"""
+        if value is None:
+            return False
+        if self.above is not None or self.below is not None:
+            if not isinstance(value, _numbers):
+                return False
+            if self.above is not None and not value > self.above:
+                return False
+            if self.below is not None and not value < self.below:
+                return False
+        if self.test is not None:
+            return bool(self.test(value))
+        return True
+
+def _indexes(fields, all_fields):
+    """Returns set of field indexes selected by fields (fields, sections
+    or a predicate that gets a field) or None if all fields are selected."""
+    if fields is None:
+        return None
+    if callable(fields):
+        return set(f.index for f in all_fields if fields(f))
+    selected = set()
+    for item in fields:
+        if hasattr(item, 'get_fields'):
+            selected.update(f.index for f in item.get_fields())
+        else:
+            selected.add(item.index)
+    return selected
+
+class StyleTable(object):
+    """Matches rules and resolves merged cell styles"""
+    def __init__(self, rules, rows, cols):
+        """
+        Keyword arguments:
+        rules --    list of Rule objects
+        rows --     all row fields of the report
+        cols --     all column fields of the report
+
+        """
+        self.rules = rules
+        self._rows = [_indexes(rule.rows, rows) for rule in rules]
+        self._cols = [_indexes(rule.cols, cols) for rule in rules]
+        self._styles = {}
+
+    def match(self, i, items, position=None):
+        """Returns list of matching rule numbers for every cell in the row
+        (empty tuples for cells without rules).
+
+        Keyword arguments:
+        i --        row field index
+        items --    row cells
+        position -- drawn row number (rows of not expanded sections
+                    and preview are not drawn). Rows are banded by it.
+
+        """
+        if position is None:
+            position = i
+        row_rules = []
+        for k, rule in enumerate(self.rules):
+            if self._rows[k] is not None and i not in self._rows[k]:
+                continue
+            if rule.band is not None and rule.axis == 'rows' and position // rule.band % 2 == 0:
+                continue
+            row_rules.append(k)
+        if not row_rules:
+            return None
+        matches = []
+        for j, item in enumerate(items):
+            matched = ()
+            for k in row_rules:
+                rule = self.rules[k]
+                if self._cols[k] is not None and j not in self._cols[k]:
+                    continue
+                if rule.band is not None:
+                    if rule.axis == 'cols' and j // rule.band % 2 == 0:
+                        continue
+                elif not rule._matches(item):
+                    continue
+                matched += (k,)
+            matches.append(matched)
+        return matches
+
+    def style(self, base, num_format, matched):
+        """Returns base style with styles of matched rules laid over it.
+        Number format of the cell is kept unless a rule sets one."""
+        key = (id(base), num_format, matched)
+        if key not in self._styles:
+            style = deepcopy(base)
+            if num_format:
+                style.num_format_str = num_format
+            for k in matched:
+                _overlay(self.rules[k].style, style)
+            self._styles[key] = (base, style)      # keep base alive, its id is in the key
+        return self._styles[key][1]
+
+    def __len__(self):
+        return len(self._styles)
+
+def _overlay(rule_style, style):
+    """Copies attributes of the rule style that differ from
+    the default style to the style"""
+    if rule_style.num_format_str != _default.num_format_str:
+        style.num_format_str = rule_style.num_format_str
+    for part in _parts:
+        default, target = getattr(_default, part), getattr(style, part)
+        for name, value in getattr(rule_style, part).__dict__.items():
+            if getattr(default, name, None) != value:
+                setattr(target, name, value)
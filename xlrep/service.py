@@ -0,0 +1,322 @@
+# -*- coding: utf-8 -*-
+import json
+import socket
+import threading
+import time
+from collections import deque
+from multiprocessing import Pool
+from SocketServer import ThreadingTCPServer, StreamRequestHandler
+from StringIO import StringIO
+from xlwt import Workbook
+from reports import ReportException
+
+"""
+Local report render service.
+
+The service keeps registered reports in a pool of worker processes, so
+a render job doesn't pay for imports and section tree construction.
+Reports are registered before the service is started. Workers are forked
+on start and get the built reports of their service.
+
+Example:
+    service = RenderService(workers=4, max_pending=32, timeout=30)
+    service.register('sales', build_sales_report())
+    service.start()
+
+    xls = service.render('sales', rows)             # in-process
+    address = service.serve()                       # or over local socket
+    xls = request(address, 'sales', rows)
+
+Socket protocol: the client sends one JSON line
+    {"report": name, "data": rows, "transpose": false, "timeout": seconds}
+and gets a JSON header line
+    {"status": "ok", "size": n, ...timings} followed by n bytes of workbook
+or
+    {"status": "error", "message": text}.
+
+"""
+
+_reports = {}   # Reports of the worker process. Set by _init.
+
+class Job(object):
+    """Render job. Returned by RenderService.submit"""
+    def __init__(self, report, timeout=None):
+        self.report = report
+        self.timeout = timeout
+        self.submitted = time.time()
+        self.finished = None
+        self.render_time = None
+        self._event = threading.Event()
+        self._value = None
+        self._error = None
+
+    def done(self):
+        return self._event.is_set()
+
+    def result(self, timeout=None):
+        """Waits for the job and returns workbook bytes.
+
+        Keyword arguments:
+        timeout --  seconds to wait. By default waits until the job is
+                    finished or the service stops it on job timeout.
+                    The job is not cancelled if only the wait times out.
+
+        """
+        if not self._event.wait(timeout):
+            raise ReportException('Render job %s timed out after %s s' % (self.report, timeout))
+        if self._error is not None:
+            raise ReportException(self._error)
+        return self._value
+
+    def timings(self):
+        """Returns dict with queue wait, render and total time of the job.
+        Wait and render time of timed out jobs are None."""
+        total = self.finished - self.submitted
+        wait = total - self.render_time if self.render_time is not None else None
+        return {'report': self.report, 'wait': wait, 'render': self.render_time, 'total': total}
+
+    def _finish(self, result):
+        ok, value, self.render_time = result
+        self.finished = time.time()
+        if ok:
+            self._value = value
+        else:
+            self._error = value
+        self._event.set()
+
+class RenderService(object):
+    WATCH_INTERVAL = 0.05       # Seconds between checks of job timeouts
+
+    def __init__(self, workers=2, max_pending=64, timeout=None, history=1000):
+        """Creates render service.
+
+        Keyword arguments:
+        workers --      number of worker processes
+        max_pending --  max number of submitted and not finished jobs.
+                        Further submits wait or fail (see submit).
+        timeout --      default job timeout in seconds. Jobs that are not
+                        finished in time (including queue wait) fail and
+                        the worker pool is restarted. Other running jobs
+                        are rendered again from the start.
+        history --      number of finished jobs kept for stats
+
+        """
+        self.workers = workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self._reports = {}
+        self._pool = None
+        self._watchdog = None
+        self._stopped = threading.Event()
+        self._server = None
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._completed = 0
+        self._failed = 0
+        self._timed_out = 0
+        self._running = set()
+        self._timings = deque(maxlen=history)
+
+    def register(self, name, report, sheet='Report'):
+        """Registers report layout. Should be called before start.
+
+        Keyword arguments:
+        name --     name used in render jobs
+        report --   Report object
+        sheet --    worksheet name
+
+        """
+        if self._pool is not None:
+            raise ReportException('Reports should be registered before the service is started')
+        self._reports[name] = (report, sheet)
+
+    def start(self):
+        """Starts worker processes"""
+        if self._pool is None:
+            self._pool = self._new_pool()
+            self._stopped.clear()
+            self._watchdog = threading.Thread(target=self._watch)
+            self._watchdog.daemon = True
+            self._watchdog.start()
+        return self
+
+    def submit(self, name, data, transpose=False, timeout=None, block=True):
+        """Submits render job. Returns Job.
+
+        Keyword arguments:
+        name --         registered report name
+        data --         report data (see Report.render)
+        transpose --    transpose matrix
+        timeout --      job timeout. By default service timeout is used.
+        block --        if the queue is full wait for a free slot.
+                        If False raise ReportException.
+
+        """
+        if self._pool is None:
+            raise ReportException('Service is not started')
+        if name not in self._reports:
+            raise ReportException('Unknown report: %s' % name)
+        # Data is read before a slot is taken, so bad data can't hold it
+        try:
+            data = list(data)
+        except Exception, e:
+            raise ReportException('Data should be a sequence of rows: %s' % e)
+        if not self._slots.acquire(block):
+            raise ReportException('Render queue is full')
+        job = Job(name, timeout if timeout is not None else self.timeout)
+        job._args = (name, data, transpose)
+        try:
+            with self._lock:
+                self._pending += 1
+                self._running.add(job)
+                self._dispatch(job)
+        except Exception, e:
+            self._finish(job, (False, 'Job is not dispatched: %s' % e, 0))
+            raise ReportException('Job is not dispatched: %s' % e)
+        return job
+
+    def _new_pool(self):
+        """Returns worker pool serving reports of the service"""
+        return Pool(self.workers, initializer=_init, initargs=(self._reports,))
+
+    def _dispatch(self, job):
+        """Sends the job to the current pool. Called under the lock."""
+        self._pool.apply_async(_render, job._args, callback=lambda result: self._finish(job, result))
+
+    def _finish(self, job, result, timed_out=False):
+        """Finishes the job and frees its slot. A job is finished once:
+        results of a job that has already timed out are ignored."""
+        with self._lock:
+            if job not in self._running:
+                return
+            self._running.discard(job)
+            job._finish(result)
+            self._pending -= 1
+            if timed_out:
+                self._timed_out += 1
+            elif job._error is None:
+                self._completed += 1
+            else:
+                self._failed += 1
+            self._timings.append(job.timings())
+        self._slots.release()
+
+    def _watch(self):
+        """Watchdog routine. Jobs that run out of time are finished and
+        the pool is replaced, so hanging workers are killed. Other running
+        jobs are killed too and sent to the new pool, where they start
+        over."""
+        while not self._stopped.wait(self.WATCH_INTERVAL):
+            now = time.time()
+            with self._lock:
+                expired = [job for job in self._running
+                           if job.timeout is not None and job.submitted + job.timeout <= now]
+            if not expired:
+                continue
+            pool = self._new_pool()
+            with self._lock:
+                old, self._pool = self._pool, pool
+            for job in expired:
+                self._finish(job, (False, 'Render job %s timed out after %s s' % (job.report, job.timeout), None), True)
+            with self._lock:
+                for job in self._running:
+                    self._dispatch(job)
+            old.terminate()
+            old.join()
+
+    def render(self, name, data, transpose=False, timeout=None):
+        """Renders report and returns workbook bytes"""
+        return self.submit(name, data, transpose, timeout).result()
+
+    def stats(self):
+        """Returns queue depth, job counters and timings of recent jobs"""
+        with self._lock:
+            return {'pending': self._pending, 'completed': self._completed,
+                    'failed': self._failed, 'timed_out': self._timed_out,
+                    'timings': list(self._timings)}
+
+    def serve(self, host='127.0.0.1', port=0):
+        """Starts socket front end in a background thread.
+        Returns (host, port) of the server."""
+        self.start()
+        self._server = ThreadingTCPServer((host, port), _Handler)
+        self._server.daemon_threads = True
+        self._server.service = self
+        thread = threading.Thread(target=self._server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self._server.server_address
+
+    def shutdown(self):
+        """Stops socket front end and worker processes"""
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        if self._watchdog is not None:
+            self._stopped.set()
+            self._watchdog.join()
+            self._watchdog = None
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+
+def _init(reports):
+    """Worker initializer. Keeps reports of the service that started
+    the pool."""
+    global _reports
+    _reports = reports
+
+def _render(name, data, transpose):
+    """Worker routine. Returns (ok, workbook bytes or error, render time)"""
+    start = time.time()
+    try:
+        report, sheet = _reports[name]
+        book = Workbook()
+        report.render(book.add_sheet(sheet), data, transpose)
+        stream = StringIO()
+        book.save(stream)
+        return True, stream.getvalue(), time.time() - start
+    except Exception, e:
+        return False, '%s: %s' % (type(e).__name__, e), time.time() - start
+
+class _Handler(StreamRequestHandler):
+    def handle(self):
+        try:
+            job = json.loads(self.rfile.readline())
+            job = self.server.service.submit(job['report'], job['data'], job.get('transpose', False),
+                                      job.get('timeout'), block=False)
+            value = job.result()
+        except Exception, e:
+            self.wfile.write(json.dumps({'status': 'error', 'message': str(e)}) + '\n')
+            return
+        header = job.timings()
+        header.update(status='ok', size=len(value))
+        self.wfile.write(json.dumps(header) + '\n')
+        self.wfile.write(value)
+
+def request(address, name, data, transpose=False, timeout=None):
+    """Sends render job to the service socket. Returns workbook bytes.
+
+    Keyword arguments:
+    address --      (host, port) returned by RenderService.serve
+    name --         registered report name
+    data --         report data (JSON serializable rows)
+    transpose --    transpose matrix
+    timeout --      job timeout
+
+    """
+    conn = socket.create_connection(address)
+    try:
+        stream = conn.makefile('rwb')
+        stream.write(json.dumps({'report': name, 'data': list(data),
+                                 'transpose': transpose, 'timeout': timeout}) + '\n')
+        stream.flush()
+        header = json.loads(stream.readline())
+        if header['status'] != 'ok':
+            raise ReportException(header['message'])
+        return stream.read(header['size'])
+    finally:
+        conn.close()
@@ -1,30 +1,51 @@
 # -*- coding: utf-8 -*-
-from xlwt import easyxf
+import sys
+from lazy import LazyModule
 
-caption_style = easyxf('''
+# Default styles. XFStyle objects are built on first access.
+specs = {
+    'default_style': '',
+
+    'caption_style': '''
             font: bold on, height 280, name Arial;
-            ''')
+            ''',
 
-description_style = easyxf('''
+    'description_style': '''
             font: height 200, name Arial;
-            ''')
+            ''',
 
-col_header_style = easyxf('''
-            font: bold on, height 200, name Arial; 
+    'col_header_style': '''
+            font: bold on, height 200, name Arial;
             align: wrap on, horiz center, vert center;
             border: left thin, right thin, top thin, bottom thin;
             pattern: pattern solid, fore-colour tan;
-            ''')
+            ''',
 
-row_header_style = easyxf('''
+    'row_header_style': '''
             font: bold on, height 200, name Arial;
             border: left thin, right thin, top thin, bottom thin;
             align: wrap on;
             pattern: pattern solid, fore-colour tan;
-            ''')
+            ''',
 
-cell_style = easyxf('''
+    'cell_style': '''
             font: height 200, name Arial;
             border: left thin, right thin, top thin, bottom thin;
             align: wrap on;
-            ''')
+            ''',
+}
+
+def _loader(spec):
+    def load():
+        from xlwt import easyxf
+        return easyxf(spec)
+    return load
+
+def style_key(style):
+    """Returns a key that is equal for styles which produce the same XF record"""
+    return (style.num_format_str, style.font._search_key(), style.alignment._search_key(),
+            style.borders._search_key(), style.pattern._search_key(), style.protection._search_key())
+
+__all__ = sorted(specs) + ['style_key']
+
+LazyModule(sys.modules[__name__], dict((name, _loader(spec)) for name, spec in specs.items()))
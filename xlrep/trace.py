@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+import json
+
+"""
+Calc field tracing.
+
+A slow report is usually slow because of one aggregation function.
+CalcTrace records every call of calc field functions while reports are
+rendered, so the function can be found without a profiler:
+
+    trace = CalcTrace()
+    report = Report('Sales', trace=trace)
+    ...
+    report.render(ws, data)
+    print trace.table()                 # the slowest calcs first
+    open('trace.json', 'w').write(trace.as_json(sort='calls'))
+
+Calls are recorded per calc field: number of calls, total and max time
+of the function, number of values it got (max and total) and number of
+None values filtered out before the call (see Report.ignore_none).
+Cached values (see AggregateCache) are not calls. Incremental aggregators
+of row by row rendering (see Report.render) are fed a row at a time, so
+every data row is a call.
+
+"""
+
+COLUMNS = ('field', 'section', 'calls', 'total', 'max', 'values', 'max_values', 'filtered')
+
+class CalcTrace(object):
+    """Collects calc field calls of the reports it is passed to"""
+    def __init__(self):
+        self._stats = {}       # field -> [calls, total, max, values, max values, filtered]
+
+    def __len__(self):
+        return len(self._stats)
+
+    def record(self, field, seconds, size, filtered):
+        """Records a call of the calc field function.
+
+        Keyword arguments:
+        field --    CalcField
+        seconds --  time of the call
+        size --     number of values passed to the function, i.e. after
+                    None values are filtered out
+        filtered -- number of None values filtered out
+
+        """
+        stats = self._stats.get(field)
+        if stats is None:
+            stats = self._stats[field] = [0, 0.0, 0.0, 0, 0, 0]
+        stats[0] += 1
+        stats[1] += seconds
+        stats[2] = max(stats[2], seconds)
+        stats[3] += size
+        stats[4] = max(stats[4], size)
+        stats[5] += filtered
+
+    def clear(self):
+        """Forgets recorded calls"""
+        self._stats.clear()
+
+    def stats(self, sort='total'):
+        """Returns list of dicts (one per calc field, keys are COLUMNS)
+        sorted by the column: names in ascending order, numbers in
+        descending order"""
+        if sort not in COLUMNS:
+            raise ValueError('Unknown column %s. Expected one of %s.' % (sort, ', '.join(COLUMNS)))
+        result = []
+        for field, stats in self._stats.items():
+            result.append(dict(zip(COLUMNS, [field.name, field.sec.name] + stats)))
+        result.sort(key=lambda item: item[sort], reverse=sort not in ('field', 'section'))
+        return result
+
+    def table(self, sort='total'):
+        """Returns stats as a text table"""
+        rows = [COLUMNS]
+        for item in self.stats(sort):
+            rows.append([unicode(item['field']), unicode(item['section']), str(item['calls']),
+                         '%.6f' % item['total'], '%.6f' % item['max'], str(item['values']),
+                         str(item['max_values']), str(item['filtered'])])
+        widths = [max(len(row[k]) for row in rows) for k in range(len(COLUMNS))]
+        lines = []
+        for row in rows:
+            cells = [row[0].ljust(widths[0]), row[1].ljust(widths[1])]
+            cells.extend(cell.rjust(width) for cell, width in zip(row[2:], widths[2:]))
+            lines.append('  '.join(cells).rstrip())
+        return '\n'.join(lines)
+
+    def as_json(self, sort='total'):
+        """Returns stats as a JSON list"""
+        return json.dumps(self.stats(sort))
+
+class _Samples(list):
+    """Collects calls of a calc evaluated in a worker process.
+    They are recorded to the trace by the parent process."""
+    def record(self, field, seconds, size, filtered):
+        self.append((seconds, size, filtered))